@@ -10,7 +10,7 @@ Model: tbs17/MathBERT (specialized for mathematical text)
 Target: 98%+ accuracy on substitution prediction
 
 Usage in Google Colab:
-  1. Upload this script
+  1. Upload this script and train_common.py
   2. Run all cells
   3. Download lemma_model.zip
 """
@@ -24,6 +24,7 @@ Usage in Google Colab:
 import torch
 import torch.nn as nn
 from torch.utils.data import Dataset, DataLoader
+from torch.cuda.amp import autocast, GradScaler
 from transformers import (
     AutoTokenizer, 
     AutoModelForSequenceClassification,
@@ -31,11 +32,11 @@ from transformers import (
     get_cosine_schedule_with_warmup
 )
 from sklearn.model_selection import train_test_split
-from sklearn.metrics import precision_recall_fscore_support
-import numpy as np
 import json
 import os
 
+from train_common import LogitsOnly
+
 # ============================================================================
 # CELL 2: Configuration - TUNED FOR PRODUCTION
 # ============================================================================
@@ -52,6 +53,7 @@ CONFIG = {
     "warmup_ratio": 0.1,             # 10% warmup
     "weight_decay": 0.01,            # L2 regularization
     "gradient_accumulation": 2,       # Effective batch = 32
+    "compile": True,                 # torch.compile(mode="reduce-overhead") on CUDA
     
     # Early stopping
     "patience": 5,                   # Stop if no improvement for 5 epochs
@@ -402,6 +404,11 @@ class IMODataset(Dataset):
         self.vocab = vocab
         self.max_length = max_length
         self.vocab_to_idx = {v: i for i, v in enumerate(vocab)}
+        # Label indices per sample, built once; __getitem__ scatters them
+        self.label_indices = [
+            torch.tensor([self.vocab_to_idx[s] for s in item["subs"] if s in self.vocab_to_idx], dtype=torch.long)
+            for item in data
+        ]
         
     def __len__(self):
         return len(self.data)
@@ -409,7 +416,6 @@ class IMODataset(Dataset):
     def __getitem__(self, idx):
         item = self.data[idx]
         text = item["text"]
-        subs = item["subs"]
         
         # Tokenize
         encoding = self.tokenizer(
@@ -421,10 +427,7 @@ class IMODataset(Dataset):
         )
         
         # Multi-hot label encoding
-        label = torch.zeros(len(self.vocab))
-        for sub in subs:
-            if sub in self.vocab_to_idx:
-                label[self.vocab_to_idx[sub]] = 1.0
+        label = torch.zeros(len(self.vocab)).scatter_(0, self.label_indices[idx], 1.0)
                 
         return {
             "input_ids": encoding["input_ids"].squeeze(),
@@ -436,41 +439,48 @@ class IMODataset(Dataset):
 # CELL 6: Training Functions
 # ============================================================================
 
-def train_epoch(model, loader, optimizer, scheduler, device, accumulation_steps=2):
-    """Train for one epoch with gradient accumulation."""
+def train_epoch(model, loader, optimizer, scheduler, scaler, device, accumulation_steps=2,
+                amp_dtype=torch.float16):
+    """Train for one epoch with gradient accumulation and mixed precision."""
     model.train()
-    total_loss = 0
-    optimizer.zero_grad()
+    total_loss = torch.zeros((), device=device)  # Summed on device, no per-step sync
+    optimizer.zero_grad(set_to_none=True)
     
     for i, batch in enumerate(loader):
         input_ids = batch["input_ids"].to(device)
         attention_mask = batch["attention_mask"].to(device)
         labels = batch["labels"].to(device)
         
-        outputs = model(input_ids=input_ids, attention_mask=attention_mask)
-        logits = outputs.logits
-        
-        # Binary cross entropy for multi-label
-        loss = nn.BCEWithLogitsLoss()(logits, labels)
-        loss = loss / accumulation_steps
-        loss.backward()
+        with autocast(enabled=device.type == "cuda", dtype=amp_dtype):
+            logits = model(input_ids, attention_mask)
+            
+            # Binary cross entropy for multi-label
+            loss = nn.BCEWithLogitsLoss()(logits, labels)
+            loss = loss / accumulation_steps
+        scaler.scale(loss).backward()
         
         if (i + 1) % accumulation_steps == 0:
+            scaler.unscale_(optimizer)
             torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
             scheduler.step()
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             
-        total_loss += loss.item() * accumulation_steps
+        total_loss += loss.detach() * accumulation_steps
         
-    return total_loss / len(loader)
+    return total_loss.item() / len(loader)
 
-def evaluate(model, loader, device):
+def evaluate(model, loader, device, amp_dtype=torch.float16):
     """Evaluate model on validation set."""
     model.eval()
-    total_loss = 0
-    all_preds = []
-    all_labels = []
+    # Running counters stay on device: a single host sync after the loop
+    total_loss = torch.zeros((), device=device)
+    exact = torch.zeros((), dtype=torch.long, device=device)
+    tp = torch.zeros((), dtype=torch.long, device=device)
+    fp = torch.zeros((), dtype=torch.long, device=device)
+    fn = torch.zeros((), dtype=torch.long, device=device)
+    num_samples = 0
     
     with torch.no_grad():
         for batch in loader:
@@ -478,30 +488,31 @@ def evaluate(model, loader, device):
             attention_mask = batch["attention_mask"].to(device)
             labels = batch["labels"].to(device)
             
-            outputs = model(input_ids=input_ids, attention_mask=attention_mask)
-            logits = outputs.logits
-            
-            loss = nn.BCEWithLogitsLoss()(logits, labels)
-            total_loss += loss.item()
+            with autocast(enabled=device.type == "cuda", dtype=amp_dtype):
+                logits = model(input_ids, attention_mask)
+                
+                loss = nn.BCEWithLogitsLoss()(logits, labels)
+            total_loss += loss.detach()
             
-            preds = (torch.sigmoid(logits) > 0.5).float()
-            all_preds.extend(preds.cpu().numpy())
-            all_labels.extend(labels.cpu().numpy())
-    
-    # Calculate metrics
-    all_preds = np.array(all_preds)
-    all_labels = np.array(all_labels)
+            preds = torch.sigmoid(logits) > 0.5
+            targets = labels.bool()
+            exact += (preds == targets).all(dim=1).sum()
+            tp += (preds & targets).sum()
+            fp += (preds & ~targets).sum()
+            fn += (~preds & targets).sum()
+            num_samples += labels.size(0)
     
     # Per-sample accuracy (all labels correct)
-    accuracy = (all_preds == all_labels).all(axis=1).mean()
+    accuracy = exact.item() / num_samples
     
     # Micro-averaged precision, recall, F1
-    precision, recall, f1, _ = precision_recall_fscore_support(
-        all_labels.flatten(), all_preds.flatten(), average='micro', zero_division=0
-    )
+    tp, fp, fn = tp.item(), fp.item(), fn.item()
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    f1 = 2 * tp / (2 * tp + fp + fn) if tp + fp + fn else 0.0
     
     return {
-        "loss": total_loss / len(loader),
+        "loss": total_loss.item() / len(loader),
         "accuracy": accuracy,
         "precision": precision,
         "recall": recall,
@@ -517,6 +528,12 @@ def main():
     print("LEMMA Production Training - MathBERT on 2000+ IMO Problems")
     print("="*70 + "\n")
     
+    # TF32 Tensor Core matmuls for the remaining FP32 ops (Ampere+, e.g. A100)
+    torch.set_float32_matmul_precision("high")
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True  # Shapes are static (max_length padding)
+    
     # Device
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"Device: {device}")
@@ -546,6 +563,14 @@ def main():
     print(f"Model loaded: {CONFIG['model_name']}")
     print(f"Parameters: {sum(p.numel() for p in model.parameters()):,}")
     
+    # Compiled wrapper shares parameters with `model`; the eager module is kept
+    # for state_dict/ONNX export. max_length padding + drop_last keep shapes static.
+    # LogitsOnly keeps ModelOutput and the loss out of the CUDA-graph region.
+    train_model = LogitsOnly(model)
+    if CONFIG["compile"] and device.type == "cuda":
+        train_model = torch.compile(train_model, mode="reduce-overhead", fullgraph=True)
+        print("torch.compile enabled (reduce-overhead, fullgraph)")
+    
     # Prepare data
     print(f"\nDataset: {len(DATA)} problems")
     train_data, val_data = train_test_split(
@@ -558,7 +583,7 @@ def main():
     train_dataset = IMODataset(train_data, tokenizer, VOCAB, CONFIG["max_length"])
     val_dataset = IMODataset(val_data, tokenizer, VOCAB, CONFIG["max_length"])
     
-    train_loader = DataLoader(train_dataset, batch_size=CONFIG["batch_size"], shuffle=True)
+    train_loader = DataLoader(train_dataset, batch_size=CONFIG["batch_size"], shuffle=True, drop_last=True)
     val_loader = DataLoader(val_dataset, batch_size=CONFIG["batch_size"])
     
     # Optimizer and scheduler
@@ -577,6 +602,11 @@ def main():
         num_training_steps=total_steps
     )
     
+    # Mixed precision: bf16 on Ampere+ (A100) needs no loss scaling
+    use_bf16 = device.type == "cuda" and torch.cuda.is_bf16_supported()
+    amp_dtype = torch.bfloat16 if use_bf16 else torch.float16
+    scaler = GradScaler(enabled=device.type == "cuda" and not use_bf16)
+    
     print(f"\nTraining for {CONFIG['epochs']} epochs")
     print(f"Total steps: {total_steps}, Warmup: {warmup_steps}")
     print("-"*70)
@@ -588,10 +618,10 @@ def main():
     
     for epoch in range(CONFIG["epochs"]):
         train_loss = train_epoch(
-            model, train_loader, optimizer, scheduler, device,
-            CONFIG["gradient_accumulation"]
+            train_model, train_loader, optimizer, scheduler, scaler, device,
+            CONFIG["gradient_accumulation"], amp_dtype
         )
-        val_metrics = evaluate(model, val_loader, device)
+        val_metrics = evaluate(train_model, val_loader, device, amp_dtype)
         
         print(f"Epoch {epoch+1:2d}/{CONFIG['epochs']} | "
               f"Train Loss: {train_loss:.4f} | "
@@ -603,7 +633,8 @@ def main():
         if val_metrics["f1"] > best_f1 + CONFIG["min_delta"]:
             best_f1 = val_metrics["f1"]
             patience_counter = 0
-            best_model_state = model.state_dict().copy()
+            # Snapshot on CPU: a real copy that doesn't hold a second model in VRAM
+            best_model_state = {k: v.detach().to("cpu", copy=True) for k, v in model.state_dict().items()}
             print(f"  ↳ New best F1: {best_f1:.4f} ✓")
         else:
             patience_counter += 1
@@ -613,11 +644,11 @@ def main():
     
     # Restore best model
     if best_model_state:
-        model.load_state_dict(best_model_state)
+        model.load_state_dict(best_model_state)  # copies back into the on-device params
     
     # Final evaluation
     print("\n" + "="*70)
-    final_metrics = evaluate(model, val_loader, device)
+    final_metrics = evaluate(train_model, val_loader, device, amp_dtype)
     print("FINAL RESULTS")
     print("="*70)
     print(f"Accuracy:  {final_metrics['accuracy']*100:.1f}%")
@@ -671,28 +702,36 @@ if __name__ == "__main__":
 # CELL 9: Test Predictions
 # ============================================================================
 
-def predict(text, model, tokenizer, vocab, k=5):
-    """Get top-k predictions for a problem."""
+def predict_batch(texts, model, tokenizer, vocab, k=5):
+    """Get top-k predictions for several problems in a single forward pass."""
     model.eval()
     device = next(model.parameters()).device
     
+    # Pad to the longest text in the batch, not max_length
     inputs = tokenizer(
-        text,
+        texts,
         return_tensors="pt",
-        max_length=256,
+        max_length=CONFIG["max_length"],
         truncation=True,
-        padding="max_length"
+        padding=True
     )
     
-    with torch.no_grad():
+    with torch.inference_mode():
         outputs = model(
             input_ids=inputs["input_ids"].to(device),
             attention_mask=inputs["attention_mask"].to(device)
         )
-        probs = torch.sigmoid(outputs.logits).squeeze().cpu().numpy()
+        probs, top_k = torch.sigmoid(outputs.logits).topk(k, dim=1)
     
-    top_k = probs.argsort()[-k:][::-1]
-    return [(vocab[i], f"{probs[i]*100:.0f}%") for i in top_k]
+    probs, top_k = probs.cpu().tolist(), top_k.cpu().tolist()
+    return [
+        [(vocab[i], f"{p*100:.0f}%") for i, p in zip(indices, row)]
+        for indices, row in zip(top_k, probs)
+    ]
+
+def predict(text, model, tokenizer, vocab, k=5):
+    """Get top-k predictions for a problem."""
+    return predict_batch([text], model, tokenizer, vocab, k)[0]
 
 # Test on real IMO problems
 print("\n" + "="*70)
@@ -706,8 +745,8 @@ TEST_PROBLEMS = [
     ("IMO 2008 P2", "Let x,y,z ≠ 1 with xyz=1. Prove x²/(x-1)² + y²/(y-1)² + z²/(z-1)² ≥ 1."),
 ]
 
-for name, text in TEST_PROBLEMS:
-    preds = predict(text, model, tokenizer, VOCAB)
+test_preds = predict_batch([text for _, text in TEST_PROBLEMS], model, tokenizer, VOCAB)
+for (name, text), preds in zip(TEST_PROBLEMS, test_preds):
     print(f"\n{name}")
     print(f"  Text: {text[:60]}...")
     for sub, conf in preds[:3]:
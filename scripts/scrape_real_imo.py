@@ -1,64 +1,109 @@
 """
 Scrape REAL IMO Problems from Art of Problem Solving Wiki
+
+Requires: pip install aiohttp
+Optional: pip install selectolax (C HTML parser for faster tag stripping)
 """
 
+import asyncio
+import html
 import json
-import time
-import urllib.request
 import re
 
+import aiohttp
+
+try:
+    from selectolax.parser import HTMLParser
+except ImportError:
+    HTMLParser = None
+
 BASE_URL = "https://artofproblemsolving.com/wiki/index.php"
 
 # Years with 6 problems each (1959-2024, excluding 1980)
 YEARS = list(range(1959, 2025))
 YEARS.remove(1980)  # No IMO in 1980
 
-def fetch_problem(year, problem_num):
+# Politeness limits for AoPS
+MAX_CONCURRENT = 4     # Requests in flight at once (also the connection pool size)
+REQUEST_DELAY = 0.25   # Seconds each slot waits after a request
+
+# Compiled once at import
+PROBLEM_SECTION_RE = re.compile(r'<h2[^>]*>.*?Problem.*?</h2>(.*?)<h2', re.DOTALL | re.IGNORECASE)
+WHITESPACE_RE = re.compile(r'\s+')
+SCRIPT_STYLE_RE = re.compile(r'<(script|style)\b[^>]*>.*?</\1\s*>', re.DOTALL | re.IGNORECASE)
+TAG_RE = re.compile(r'<[^>]+>')
+
+# Every keyword classify_problem checks. The zero-width lookahead reports
+# overlapping occurrences too, so one C-level scan finds all of them.
+KEYWORDS = [
+    'function', 'f(', 'injective', 'linear',
+    'prove', '>', '<', 'geq', 'leq', 'abc', '1',
+    'integer', 'divis', 'prime', 'mod',
+    'triangle', 'circle', 'point',
+]
+KEYWORD_RE = re.compile('(?=(' + '|'.join(map(re.escape, KEYWORDS)) + '))')
+
+def html_to_text(fragment):
+    """Strip tags, drop <script>/<style> content and decode entities."""
+    if HTMLParser is not None:
+        tree = HTMLParser(fragment)
+        tree.strip_tags(['script', 'style'])
+        return tree.body.text(separator=' ') if tree.body is not None else ''
+    text = SCRIPT_STYLE_RE.sub(' ', fragment)
+    text = TAG_RE.sub(' ', text)
+    return html.unescape(text)
+
+def extract_problem(html):
+    """Extract the problem statement from an AoPS wiki page."""
+    # Extract problem text between "Problem" header and "Solution" header
+    # This is a simplified extraction - may need refinement
+    match = PROBLEM_SECTION_RE.search(html)
+    if match:
+        # Clean HTML tags
+        text = html_to_text(match.group(1))
+        text = WHITESPACE_RE.sub(' ', text).strip()
+        # Remove LaTeX artifacts
+        text = text.replace('\\\\', ' ').replace('\\', '')
+        return text[:1000]  # Limit length
+    return None
+
+async def fetch_problem(session, sem, year, problem_num):
     """Fetch a single IMO problem from AoPS Wiki."""
     url = f"{BASE_URL}/{year}_IMO_Problems/Problem_{problem_num}"
     try:
-        with urllib.request.urlopen(url, timeout=10) as response:
-            html = response.read().decode('utf-8')
-            
-        # Extract problem text between "Problem" header and "Solution" header
-        # This is a simplified extraction - may need refinement
-        match = re.search(r'<h2[^>]*>.*?Problem.*?</h2>(.*?)<h2', html, re.DOTALL | re.IGNORECASE)
-        if match:
-            text = match.group(1)
-            # Clean HTML tags
-            text = re.sub(r'<[^>]+>', ' ', text)
-            text = re.sub(r'\s+', ' ', text).strip()
-            # Remove LaTeX artifacts
-            text = text.replace('\\\\', ' ').replace('\\', '')
-            return text[:1000]  # Limit length
-        return None
+        async with sem:
+            async with session.get(url) as response:
+                response.raise_for_status()
+                html = await response.text()
+            await asyncio.sleep(REQUEST_DELAY)  # Be polite to the server
+        return extract_problem(html)
     except Exception as e:
         print(f"Error fetching {year} P{problem_num}: {e}")
         return None
 
 def classify_problem(text):
     """Classify problem type and suggest substitutions."""
-    text_lower = text.lower()
+    found = set(KEYWORD_RE.findall(text.lower()))
     
-    if 'function' in text_lower or 'f(' in text_lower:
+    if found & {'function', 'f('}:
         category = "Functional Equation"
         subs = ["x = 0", "y = 0", "x = y"]
-        if 'injective' in text_lower:
+        if 'injective' in found:
             subs.append("Assume f is injective")
-        if 'linear' in text_lower:
+        if 'linear' in found:
             subs.append("Assume f is linear")
-    elif 'prove' in text_lower and ('>' in text or '<' in text or 'geq' in text_lower or 'leq' in text_lower):
+    elif 'prove' in found and found & {'>', '<', 'geq', 'leq'}:
         category = "Algebra"
         subs = ["Apply AM-GM", "Apply Cauchy-Schwarz"]
-        if 'abc' in text_lower and '1' in text:
+        if 'abc' in found and '1' in found:
             subs.append("abc = 1 constraint")
         subs.append("a = b = c = 1")
-    elif 'integer' in text_lower or 'divis' in text_lower or 'prime' in text_lower or 'mod' in text_lower:
+    elif found & {'integer', 'divis', 'prime', 'mod'}:
         category = "Number Theory"
         subs = ["Check small cases", "Use modular arithmetic"]
-        if 'prime' in text_lower:
+        if 'prime' in found:
             subs.append("Consider p = 2 separately")
-    elif 'triangle' in text_lower or 'circle' in text_lower or 'point' in text_lower:
+    elif found & {'triangle', 'circle', 'point'}:
         category = "Geometry"
         subs = ["Check small cases"]
     else:
@@ -67,42 +112,49 @@ def classify_problem(text):
     
     return category, subs
 
-def main():
+async def main():
     problems = []
     
     print("Fetching real IMO problems from AoPS Wiki...")
-    print("This will take a while (1 request per second to be polite)")
+    print(f"This will take a while ({MAX_CONCURRENT} concurrent requests to be polite)")
+    
+    sem = asyncio.Semaphore(MAX_CONCURRENT)
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT, keepalive_timeout=30)
+    timeout = aiohttp.ClientTimeout(total=10)
     
-    for year in YEARS:
-        # Most years have 6 problems, early years had more
-        max_problems = 7 if year <= 1963 else 6
-        
-        for pnum in range(1, max_problems + 1):
-            print(f"  {year} Problem {pnum}...", end=" ")
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        for year in YEARS:
+            # Most years have 6 problems, early years had more
+            max_problems = 7 if year <= 1963 else 6
+            pnums = range(1, max_problems + 1)
+            
+            texts = await asyncio.gather(
+                *(fetch_problem(session, sem, year, pnum) for pnum in pnums)
+            )
             
-            text = fetch_problem(year, pnum)
-            if text and len(text) > 50:
-                category, subs = classify_problem(text)
-                problems.append({
-                    "year": year,
-                    "problem": pnum,
-                    "source": f"IMO {year} P{pnum}",
-                    "category": category,
-                    "statement": text,
-                    "subs": subs,
-                    "verified": True
-                })
-                print(f"OK ({len(text)} chars)")
-            else:
-                print("SKIP")
+            for pnum, text in zip(pnums, texts):
+                print(f"  {year} Problem {pnum}...", end=" ")
+                
+                if text and len(text) > 50:
+                    category, subs = classify_problem(text)
+                    problems.append({
+                        "year": year,
+                        "problem": pnum,
+                        "source": f"IMO {year} P{pnum}",
+                        "category": category,
+                        "statement": text,
+                        "subs": subs,
+                        "verified": True
+                    })
+                    print(f"OK ({len(text)} chars)")
+                else:
+                    print("SKIP")
             
-            time.sleep(1)  # Be polite to the server
-        
-        # Save progress every 5 years
-        if year % 5 == 0:
-            with open("data/imo_problems_progress.json", "w", encoding="utf-8") as f:
-                json.dump(problems, f, indent=2, ensure_ascii=False)
-            print(f"  Progress saved: {len(problems)} problems")
+            # Save progress every 5 years
+            if year % 5 == 0:
+                with open("data/imo_problems_progress.json", "w", encoding="utf-8") as f:
+                    json.dump(problems, f, indent=2, ensure_ascii=False)
+                print(f"  Progress saved: {len(problems)} problems")
     
     # Final save
     with open("data/real_imo_problems.json", "w", encoding="utf-8") as f:
@@ -122,4 +174,4 @@ def main():
         print(f"  {c}: {n}")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
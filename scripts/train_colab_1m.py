@@ -4,8 +4,8 @@ LEMMA MathBERT Training - Google Colab Version
 Production training on 1M synthetic problems with 30 epochs.
 
 Instructions:
-1. Upload this file and data/synthetic_1000000.json to Colab
-2. Run: !pip install transformers torch accelerate tqdm -q
+1. Upload this file, train_common.py and data/synthetic_1000000.json to Colab
+2. Run: !pip install transformers torch accelerate tqdm onnxruntime orjson -q
 3. Execute all cells
 4. Download the model folder when complete
 
@@ -15,20 +15,25 @@ Estimated time: ~4-6 hours on T4 GPU, ~2-3 hours on A100
 import torch
 import torch.nn as nn
 from torch.utils.data import Dataset, DataLoader
+from torch.cuda.amp import autocast, GradScaler
 from transformers import (
-    BertConfig, 
-    BertForSequenceClassification,
+    AutoModelForSequenceClassification,
     AutoTokenizer, 
+    DataCollatorWithPadding,
     get_cosine_schedule_with_warmup
 )
 from sklearn.model_selection import train_test_split
 import numpy as np
+import hashlib
+import itertools
 import json
 import os
 from tqdm.auto import tqdm
 
+from train_common import LogitsOnly, load_problems, worker_init_fn
+
 # ============================================================================
-# CONFIGURATION - 30 epochs, 10 layer BERT
+# CONFIGURATION - 30 epochs, pretrained DistilBERT
 # ============================================================================
 VOCAB = [
     "x = 0", "y = 0", "x = y", "x = 1", "y = 1",
@@ -39,130 +44,251 @@ VOCAB = [
 ]
 
 CONFIG = {
-    # Model architecture - 10 layer BERT
-    "hidden_size": 768,
-    "num_hidden_layers": 10,
-    "num_attention_heads": 12,
-    "intermediate_size": 3072,
-    "hidden_dropout_prob": 0.1,
-    "attention_probs_dropout_prob": 0.1,
+    # Model - pretrained 6-layer DistilBERT (converges much faster than a
+    # randomly initialized 10-layer BERT, at ~half the FLOPs per step)
+    "model_name": "distilbert-base-uncased",
     
     # Training
     "max_length": 256,
     "epochs": 30,
     "batch_size": 64,  # Larger batch for GPU
+    "gradient_accumulation": 2,  # Effective batch = 128
     "learning_rate": 3e-5,
     "warmup_ratio": 0.1,
     "weight_decay": 0.01,
     "max_samples": None,  # Use all 1M
+    "dynamic_padding": True,  # Pad to longest in batch (multiple of 8) instead of max_length
+    "compile": True,  # torch.compile on CUDA (CUDA graphs only with static padding)
+    
+    # DataLoader
+    "num_workers": min(8, os.cpu_count() or 1),
+    "prefetch_factor": 4,
     
     # Output
     "output_dir": "lemma_mathbert_1m",
     "save_every_n_epochs": 5,  # Checkpoint every 5 epochs
+    "cache_dir": ".cache",  # Memory-mapped tokenizer outputs, reused across runs
 }
 
 # ============================================================================
 # DATASET
 # ============================================================================
 class SyntheticMathDataset(Dataset):
-    def __init__(self, data, tokenizer, vocab, max_length=256):
-        self.data = data
-        self.tokenizer = tokenizer
+    """Pre-tokenized dataset: tokenization runs once here, not per __getitem__.
+    
+    Token ids are kept unpadded in one flat int32 tensor indexed by per-sample
+    offsets; padding is left to the DataLoader collator. With `cache_prefix`
+    the arrays are saved as .npy files and memory-mapped on later runs.
+    """
+    
+    CACHE_FIELDS = ("input_ids", "offsets", "labels")
+    
+    def __init__(self, data, tokenizer, vocab, max_length=256, chunk_size=10000, cache_prefix=None):
         self.vocab_to_idx = {v: i for i, v in enumerate(vocab)}
         self.max_length = max_length
         
+        # "labels" is written last, so its presence marks a complete cache
+        if cache_prefix and os.path.exists(f"{cache_prefix}.labels.npy"):
+            for field in self.CACHE_FIELDS:
+                # Copy-on-write mapping: pages load lazily and are shared by workers
+                array = np.load(f"{cache_prefix}.{field}.npy", mmap_mode="c")
+                setattr(self, field, torch.from_numpy(array))
+            return
+        
+        # Batch-tokenize in chunks to bound peak memory on 1M problems
+        input_ids, lengths = [], []
+        for start in range(0, len(data), chunk_size):
+            texts = [item["statement"] for item in data[start:start + chunk_size]]
+            encoding = tokenizer(texts, max_length=max_length, truncation=True)
+            lengths.extend(len(ids) for ids in encoding["input_ids"])
+            input_ids.append(torch.tensor(
+                list(itertools.chain.from_iterable(encoding["input_ids"])), dtype=torch.int32
+            ))
+        self.input_ids = torch.cat(input_ids)
+        self.offsets = torch.zeros(len(data) + 1, dtype=torch.long)
+        self.offsets[1:] = torch.as_tensor(lengths, dtype=torch.long).cumsum(0)
+        
+        # Multi-label targets: collect (row, col) pairs, then one vectorized scatter
+        rows, cols = [], []
+        for i, item in enumerate(data):
+            for sub in item.get("substitutions", []):
+                j = self.vocab_to_idx.get(sub)
+                if j is not None:
+                    rows.append(i)
+                    cols.append(j)
+        # Stored as bool (1 byte/label); cast to float on the GPU in the train loop
+        self.labels = torch.zeros(len(data), len(self.vocab_to_idx), dtype=torch.bool)
+        self.labels[torch.as_tensor(rows, dtype=torch.long), torch.as_tensor(cols, dtype=torch.long)] = True
+        
+        if cache_prefix:
+            os.makedirs(os.path.dirname(cache_prefix) or ".", exist_ok=True)
+            for field in self.CACHE_FIELDS:
+                np.save(f"{cache_prefix}.{field}.npy", getattr(self, field).numpy())
+        
     def __len__(self):
-        return len(self.data)
+        return len(self.labels)
     
     def __getitem__(self, idx):
-        item = self.data[idx]
-        text = item["statement"]
-        subs = item.get("substitutions", [])
+        input_ids = self.input_ids[self.offsets[idx]:self.offsets[idx + 1]].long()
+        return {
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+            "labels": self.labels[idx]
+        }
+
+class CUDAPrefetcher:
+    """Yields batches already on `device`.
+    
+    On CUDA the next batch is copied on a side stream while the current one is
+    being computed on, hiding the host-to-device transfer.
+    """
+    
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+    
+    def __len__(self):
+        return len(self.loader)
+    
+    def __iter__(self):
+        if self.device.type != "cuda":
+            for batch in self.loader:
+                yield {k: v.to(self.device) for k, v in batch.items()}
+            return
         
-        # Multi-label target
-        labels = torch.zeros(len(self.vocab_to_idx))
-        for sub in subs:
-            if sub in self.vocab_to_idx:
-                labels[self.vocab_to_idx[sub]] = 1.0
+        stream = torch.cuda.Stream()
+        batches = iter(self.loader)
         
-        encoding = self.tokenizer(
-            text,
-            max_length=self.max_length,
-            padding="max_length",
-            truncation=True,
-            return_tensors="pt"
-        )
+        def preload():
+            batch = next(batches, None)
+            if batch is None:
+                return None
+            with torch.cuda.stream(stream):
+                return {k: v.to(self.device, non_blocking=True) for k, v in batch.items()}
         
-        return {
-            "input_ids": encoding["input_ids"].squeeze(),
-            "attention_mask": encoding["attention_mask"].squeeze(),
-            "labels": labels
-        }
+        pending = preload()
+        while pending is not None:
+            current = torch.cuda.current_stream()
+            current.wait_stream(stream)
+            batch = pending
+            for tensor in batch.values():
+                tensor.record_stream(current)  # Allocated on the side stream
+            pending = preload()
+            yield batch
 
 # ============================================================================
 # TRAINING FUNCTIONS
 # ============================================================================
-def train_epoch(model, loader, optimizer, scheduler, device, epoch):
+def train_epoch(model, loader, optimizer, scheduler, scaler, device, epoch, amp_dtype,
+                accumulation_steps=1, log_every=20):
     model.train()
-    total_loss = 0
+    total_loss = torch.zeros((), device=device)  # Summed on device, no per-step sync
+    optimizer.zero_grad(set_to_none=True)
     pbar = tqdm(loader, desc=f"Epoch {epoch}")
     
-    for batch in pbar:
-        optimizer.zero_grad()
-        outputs = model(
-            input_ids=batch["input_ids"].to(device),
-            attention_mask=batch["attention_mask"].to(device),
-            labels=batch["labels"].to(device)
-        )
-        loss = outputs.loss
-        loss.backward()
-        torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-        optimizer.step()
-        scheduler.step()
-        total_loss += loss.item()
-        pbar.set_postfix({"loss": f"{loss.item():.4f}", "lr": f"{scheduler.get_last_lr()[0]:.2e}"})
-    
-    return total_loss / len(loader)
+    for step, batch in enumerate(pbar):  # Batches arrive on device (CUDAPrefetcher)
+        labels = batch["labels"].float()
+        with autocast(enabled=device.type == "cuda", dtype=amp_dtype):  # Mixed precision
+            logits = model(
+                input_ids=batch["input_ids"],
+                attention_mask=batch["attention_mask"]
+            )
+            loss = nn.BCEWithLogitsLoss()(logits, labels)
+            loss = loss / accumulation_steps
+        scaler.scale(loss).backward()
+        
+        if (step + 1) % accumulation_steps == 0:
+            scaler.unscale_(optimizer)
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            scaler.step(optimizer)
+            scaler.update()
+            scheduler.step()
+            optimizer.zero_grad(set_to_none=True)
+        
+        total_loss += loss.detach() * accumulation_steps
+        # .item() blocks on the GPU, so only refresh the progress bar every N steps
+        if step % log_every == 0:
+            pbar.set_postfix({"loss": f"{loss.item() * accumulation_steps:.4f}", "lr": f"{scheduler.get_last_lr()[0]:.2e}"})
+    
+    return total_loss.item() / len(loader)
 
-def evaluate(model, loader, device):
+def evaluate(model, loader, device, amp_dtype):
     model.eval()
-    total_loss = 0
-    all_preds = []
-    all_labels = []
+    # Running counters stay on device: a single host sync after the loop
+    total_loss = torch.zeros((), device=device)
+    exact = torch.zeros((), dtype=torch.long, device=device)
+    tp = torch.zeros((), dtype=torch.long, device=device)
+    fp = torch.zeros((), dtype=torch.long, device=device)
+    fn = torch.zeros((), dtype=torch.long, device=device)
+    num_samples = 0
     
     with torch.no_grad():
         for batch in tqdm(loader, desc="Evaluating"):
-            outputs = model(
-                input_ids=batch["input_ids"].to(device),
-                attention_mask=batch["attention_mask"].to(device),
-                labels=batch["labels"].to(device)
-            )
-            total_loss += outputs.loss.item()
+            targets = batch["labels"]
+            with autocast(enabled=device.type == "cuda", dtype=amp_dtype):
+                logits = model(
+                    input_ids=batch["input_ids"],
+                    attention_mask=batch["attention_mask"]
+                )
+                loss = nn.BCEWithLogitsLoss()(logits, targets.float())
+            total_loss += loss.detach()
             
-            preds = (torch.sigmoid(outputs.logits) > 0.5).float()
-            all_preds.append(preds.cpu())
-            all_labels.append(batch["labels"])
-    
-    all_preds = torch.cat(all_preds)
-    all_labels = torch.cat(all_labels)
+            preds = torch.sigmoid(logits) > 0.5
+            exact += (preds == targets).all(dim=1).sum()
+            tp += (preds & targets).sum()
+            fp += (preds & ~targets).sum()
+            fn += (~preds & targets).sum()
+            num_samples += targets.size(0)
     
     # Metrics
-    exact_match = (all_preds == all_labels).all(dim=1).float().mean().item()
-    per_label_acc = (all_preds == all_labels).float().mean(dim=0)
-    
+    tp, fp, fn = tp.item(), fp.item(), fn.item()
     return {
-        "loss": total_loss / len(loader),
-        "exact_match": exact_match,
-        "per_label_acc": per_label_acc.mean().item()
+        "loss": total_loss.item() / len(loader),
+        "exact_match": exact.item() / num_samples,
+        "per_label_acc": 1 - (fp + fn) / (num_samples * len(VOCAB)),
+        "micro_f1": 2 * tp / max(2 * tp + fp + fn, 1),
     }
 
+# ============================================================================
+# ONNX OPTIMIZATION
+# ============================================================================
+def optimize_onnx(onnx_path, model_config):
+    """Fuse BERT subgraphs in place and write an INT8 copy for CPU deployment."""
+    try:
+        from onnxruntime.transformers.optimizer import optimize_model
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+    except ImportError:
+        print("   💡 pip install onnxruntime to fuse and quantize the ONNX graph")
+        return
+    
+    try:
+        # Attention / SkipLayerNorm / Gelu fusions
+        optimized = optimize_model(
+            onnx_path,
+            model_type="bert",
+            num_heads=model_config.num_attention_heads,
+            hidden_size=model_config.hidden_size,
+            opt_level=99,
+        )
+        optimized.save_model_to_file(onnx_path)
+        print(f"   ✅ ONNX graph fused: {onnx_path}")
+        
+        # Dynamic INT8 weights (~4x smaller)
+        int8_path = onnx_path.replace(".onnx", "_int8.onnx")
+        quantize_dynamic(onnx_path, int8_path, weight_type=QuantType.QInt8)
+        size_mb = os.path.getsize(int8_path) / (1024 * 1024)
+        print(f"   ✅ INT8 ONNX saved: {int8_path} ({size_mb:.1f} MB)")
+        print("   💡 INT8 is only faster on CPUs with VNNI (AVX512-VNNI / AVX-VNNI)")
+    except Exception as e:
+        print(f"   ⚠️ ONNX optimization failed, keeping unoptimized graph: {e}")
+
 # ============================================================================
 # MAIN
 # ============================================================================
 def main():
     print("=" * 70)
     print("  LEMMA MathBERT Training - 1M Synthetic Problems")
-    print("  30 Epochs | 10-Layer BERT | Production Quality")
+    print("  30 Epochs | Pretrained DistilBERT | Production Quality")
     print("=" * 70)
     
     # Device
@@ -178,8 +304,7 @@ def main():
     if not os.path.exists(data_file):
         data_file = "data/synthetic_1000000.json"  # Local path
     
-    with open(data_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    data = load_problems(data_file)
     print(f"   Loaded {len(data):,} problems")
     
     if CONFIG["max_samples"]:
@@ -188,23 +313,14 @@ def main():
         data = random.sample(data, CONFIG["max_samples"])
         print(f"   Subsampled to {len(data):,}")
     
-    # Create 10-layer BERT model
-    print("\n🧠 Creating 10-layer BERT model...")
-    tokenizer = AutoTokenizer.from_pretrained("bert-base-uncased")
-    
-    config = BertConfig(
-        vocab_size=tokenizer.vocab_size,
-        hidden_size=CONFIG["hidden_size"],
-        num_hidden_layers=CONFIG["num_hidden_layers"],
-        num_attention_heads=CONFIG["num_attention_heads"],
-        intermediate_size=CONFIG["intermediate_size"],
-        hidden_dropout_prob=CONFIG["hidden_dropout_prob"],
-        attention_probs_dropout_prob=CONFIG["attention_probs_dropout_prob"],
+    # Load pretrained DistilBERT
+    print(f"\n🧠 Loading pretrained {CONFIG['model_name']}...")
+    tokenizer = AutoTokenizer.from_pretrained(CONFIG["model_name"], use_fast=True)
+    model = AutoModelForSequenceClassification.from_pretrained(
+        CONFIG["model_name"],
         num_labels=len(VOCAB),
         problem_type="multi_label_classification"
     )
-    
-    model = BertForSequenceClassification(config)
     model.to(device)
     
     total_params = sum(p.numel() for p in model.parameters())
@@ -212,16 +328,56 @@ def main():
     print(f"   Total parameters: {total_params:,}")
     print(f"   Trainable: {trainable_params:,}")
     
+    # Compiled wrapper shares parameters with `model`; keep the eager module for
+    # saving/ONNX export. CUDA graphs (reduce-overhead) need static shapes, i.e.
+    # max_length padding + drop_last; dynamic padding compiles for dynamic shapes.
+    train_model = LogitsOnly(model)
+    if CONFIG["compile"] and device.type == "cuda":
+        if CONFIG["dynamic_padding"]:
+            train_model = torch.compile(train_model, dynamic=True, fullgraph=True)
+            print("   ✓ torch.compile enabled (dynamic shapes, fullgraph)")
+        else:
+            train_model = torch.compile(train_model, mode="reduce-overhead", fullgraph=True)
+            print("   ✓ torch.compile enabled (reduce-overhead, fullgraph)")
+    
     # Split data
     train_data, val_data = train_test_split(data, test_size=0.05, random_state=42)
     print(f"\n📊 Train: {len(train_data):,}, Val: {len(val_data):,}")
     
-    # Datasets
-    train_dataset = SyntheticMathDataset(train_data, tokenizer, VOCAB, CONFIG["max_length"])
-    val_dataset = SyntheticMathDataset(val_data, tokenizer, VOCAB, CONFIG["max_length"])
+    # Datasets (tokenized once up front)
+    # Cache key covers everything that changes the tokenized arrays
+    cache_key = hashlib.sha1(
+        f"{CONFIG['model_name']}:{CONFIG['max_length']}:{CONFIG['max_samples']}:"
+        f"{os.path.getmtime(data_file)}:{VOCAB}".encode()
+    ).hexdigest()[:12]
+    cache_prefix = f"{CONFIG['cache_dir']}/tok_{cache_key}"
+    
+    print(f"\n🔤 Tokenizing (cache: {cache_prefix}_*)...")
+    train_dataset = SyntheticMathDataset(
+        train_data, tokenizer, VOCAB, CONFIG["max_length"], cache_prefix=f"{cache_prefix}_train"
+    )
+    val_dataset = SyntheticMathDataset(
+        val_data, tokenizer, VOCAB, CONFIG["max_length"], cache_prefix=f"{cache_prefix}_val"
+    )
+    
+    # Pad per batch; multiples of 8 keep Tensor Core friendly shapes
+    if CONFIG["dynamic_padding"]:
+        collate = DataCollatorWithPadding(tokenizer, pad_to_multiple_of=8, return_tensors="pt")
+    else:
+        collate = DataCollatorWithPadding(
+            tokenizer, padding="max_length", max_length=CONFIG["max_length"], return_tensors="pt"
+        )
     
-    train_loader = DataLoader(train_dataset, batch_size=CONFIG["batch_size"], shuffle=True, num_workers=2, pin_memory=True)
-    val_loader = DataLoader(val_dataset, batch_size=CONFIG["batch_size"], num_workers=2, pin_memory=True)
+    loader_kwargs = dict(
+        num_workers=CONFIG["num_workers"],
+        pin_memory=True,
+        persistent_workers=True,
+        prefetch_factor=CONFIG["prefetch_factor"],
+        worker_init_fn=worker_init_fn,
+        collate_fn=collate,
+    )
+    train_loader = DataLoader(train_dataset, batch_size=CONFIG["batch_size"], shuffle=True, drop_last=True, **loader_kwargs)
+    val_loader = DataLoader(val_dataset, batch_size=CONFIG["batch_size"], **loader_kwargs)
     
     # Optimizer
     optimizer = torch.optim.AdamW(
@@ -230,16 +386,25 @@ def main():
         weight_decay=CONFIG["weight_decay"]
     )
     
-    total_steps = len(train_loader) * CONFIG["epochs"]
+    effective_batch = CONFIG["batch_size"] * CONFIG["gradient_accumulation"]
+    steps_per_epoch = len(train_loader) // CONFIG["gradient_accumulation"]
+    total_steps = steps_per_epoch * CONFIG["epochs"]
     warmup_steps = int(total_steps * CONFIG["warmup_ratio"])
     scheduler = get_cosine_schedule_with_warmup(optimizer, warmup_steps, total_steps)
     
+    # AMP: bf16 on Ampere+ (no loss scaling needed), fp16 + GradScaler otherwise
+    use_bf16 = device.type == "cuda" and torch.cuda.is_bf16_supported()
+    amp_dtype = torch.bfloat16 if use_bf16 else torch.float16
+    scaler = GradScaler(enabled=device.type == "cuda" and not use_bf16)
+    
     print(f"\n⚙️  Training Configuration:")
     print(f"   Epochs: {CONFIG['epochs']}")
-    print(f"   Batch size: {CONFIG['batch_size']}")
-    print(f"   Steps per epoch: {len(train_loader):,}")
+    print(f"   Batch size: {CONFIG['batch_size']} x {CONFIG['gradient_accumulation']} = {effective_batch}")
+    print(f"   Steps per epoch: {steps_per_epoch:,}")
     print(f"   Total steps: {total_steps:,}")
     print(f"   Warmup steps: {warmup_steps:,}")
+    if device.type == "cuda":
+        print(f"   ✓ Mixed Precision (AMP) enabled ({'bf16' if use_bf16 else 'fp16'})")
     
     # Training loop
     print("\n" + "=" * 70)
@@ -254,8 +419,11 @@ def main():
         print(f"Epoch {epoch}/{CONFIG['epochs']}")
         print('─' * 70)
         
-        train_loss = train_epoch(model, train_loader, optimizer, scheduler, device, epoch)
-        val_metrics = evaluate(model, val_loader, device)
+        train_loss = train_epoch(
+            train_model, CUDAPrefetcher(train_loader, device), optimizer, scheduler, scaler,
+            device, epoch, amp_dtype, CONFIG["gradient_accumulation"]
+        )
+        val_metrics = evaluate(train_model, CUDAPrefetcher(val_loader, device), device, amp_dtype)
         
         history.append({
             "epoch": epoch,
@@ -268,6 +436,7 @@ def main():
         print(f"   Val Loss: {val_metrics['loss']:.4f}")
         print(f"   Exact Match: {val_metrics['exact_match']:.4f}")
         print(f"   Per-Label Acc: {val_metrics['per_label_acc']:.4f}")
+        print(f"   Micro F1: {val_metrics['micro_f1']:.4f}")
         
         # Save checkpoint
         if epoch % CONFIG["save_every_n_epochs"] == 0:
@@ -324,6 +493,7 @@ def main():
         if os.path.exists(onnx_path):
             size_mb = os.path.getsize(onnx_path) / (1024 * 1024)
             print(f"   ✅ ONNX saved: {onnx_path} ({size_mb:.1f} MB)")
+            optimize_onnx(onnx_path, model_cpu.config)
         else:
             print(f"   ⚠️ ONNX file not created")
             
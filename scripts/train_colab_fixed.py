@@ -8,28 +8,39 @@ Fixes:
 4. Gradient accumulation for larger effective batch
 5. More DataLoader workers
 6. Throttled saving
+7. Multi-GPU DDP when launched with torchrun
 
-Usage on Colab:
-  !pip install transformers torch accelerate tqdm scikit-learn -q
+Usage on Colab (upload train_common.py next to this script):
+  !pip install transformers torch accelerate tqdm scikit-learn orjson -q
   !python train_colab_fixed.py
+
+Multi-GPU:
+  torchrun --nproc_per_node=NGPU train_colab_fixed.py
 """
 
 import torch
+import torch.distributed as dist
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader
-from torch.cuda.amp import autocast, GradScaler
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import Dataset, DataLoader, DistributedSampler
+from torch.amp import autocast, GradScaler
 from transformers import (
     BertForSequenceClassification,
     AutoTokenizer, 
+    DataCollatorWithPadding,
     get_cosine_schedule_with_warmup
 )
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import f1_score, precision_score, recall_score
 import numpy as np
+import contextlib
+import hashlib
 import json
 import os
 from tqdm.auto import tqdm
 
+from train_common import LengthGroupedBatchSampler, load_problems, worker_init_fn
+
 # ============================================================================
 # CONFIGURATION - FIXED
 # ============================================================================
@@ -54,54 +65,97 @@ CONFIG = {
     "warmup_ratio": 0.1,
     "weight_decay": 0.01,
     "max_samples": 200000,       # 200K is enough for good model
+    "dynamic_padding": True,     # Pad to longest in a length-grouped batch, not max_length
+    "compile": True,             # torch.compile on CUDA (CUDA graphs only with static padding)
     
     # DataLoader
-    "num_workers": 4,
+    "num_workers": min(8, os.cpu_count() or 1),
+    "prefetch_factor": 4,
+    
+    # DDP (torchrun only)
+    "bucket_cap_mb": 50,         # Gradient all-reduce bucket size
     
     # Saving
     "save_every_n_epochs": 2,    # Don't save every best
     
     # Output
     "output_dir": "lemma_mathbert_v2",
+    "cache_dir": ".cache",       # Tokenized arrays, reused across runs
 }
 
 # ============================================================================
 # DATASET
 # ============================================================================
 class MathDataset(Dataset):
-    def __init__(self, data, tokenizer, vocab, max_length=128):
-        self.data = data
+    """Pre-tokenized dataset: tokenization runs once here, not per __getitem__.
+    
+    Token ids are kept unpadded in one flat int32 array indexed by per-sample
+    offsets; padding is left to the DataLoader collator. With `cache_prefix`
+    the arrays are saved as .npy files and memory-mapped on later runs.
+    """
+    
+    CACHE_FIELDS = ("input_ids", "offsets", "labels")
+    
+    def __init__(self, data, tokenizer, vocab, max_length=128, chunk_size=10000, cache_prefix=None):
         self.tokenizer = tokenizer
         self.vocab_to_idx = {v: i for i, v in enumerate(vocab)}
         self.max_length = max_length
         
-    def __len__(self):
-        return len(self.data)
-    
-    def __getitem__(self, idx):
-        item = self.data[idx]
-        text = item["statement"]
-        subs = item.get("substitutions", [])
+        # "labels" is written last, so its presence marks a complete cache
+        if cache_prefix and os.path.exists(f"{cache_prefix}.labels.npy"):
+            for field in self.CACHE_FIELDS:
+                # Copy-on-write mapping: pages load lazily and are shared by workers
+                setattr(self, field, np.load(f"{cache_prefix}.{field}.npy", mmap_mode="c"))
+            self.lengths = np.diff(self.offsets)
+            return
         
-        labels = torch.zeros(len(self.vocab_to_idx))
-        for sub in subs:
-            if sub in self.vocab_to_idx:
-                labels[self.vocab_to_idx[sub]] = 1.0
+        # Batch-tokenize once up front; padding is left to the DataLoader collator
+        input_ids = []
+        for start in range(0, len(data), chunk_size):
+            texts = [item["statement"] for item in data[start:start + chunk_size]]
+            encoding = self.tokenizer(texts, max_length=max_length, truncation=True)
+            input_ids.extend(np.asarray(ids, dtype=np.int32) for ids in encoding["input_ids"])
+        self.lengths = np.array([len(ids) for ids in input_ids], dtype=np.int64)
+        self.offsets = np.zeros(len(data) + 1, dtype=np.int64)
+        np.cumsum(self.lengths, out=self.offsets[1:])
+        self.input_ids = np.concatenate(input_ids) if input_ids else np.zeros(0, dtype=np.int32)
         
-        encoding = self.tokenizer(
-            text,
-            max_length=self.max_length,
-            padding="max_length",
-            truncation=True,
-            return_tensors="pt"
-        )
+        # Multi-label targets: collect (row, col) pairs, then one vectorized scatter
+        rows, cols = [], []
+        for i, item in enumerate(data):
+            for sub in item.get("substitutions", []):
+                j = self.vocab_to_idx.get(sub)
+                if j is not None:
+                    rows.append(i)
+                    cols.append(j)
+        self.labels = np.zeros((len(data), len(self.vocab_to_idx)), dtype=np.float32)
+        self.labels[rows, cols] = 1.0
         
+        if cache_prefix:
+            os.makedirs(os.path.dirname(cache_prefix) or ".", exist_ok=True)
+            for field in self.CACHE_FIELDS:
+                np.save(f"{cache_prefix}.{field}.npy", getattr(self, field))
+        
+    def __len__(self):
+        return len(self.labels)
+    
+    def __getitem__(self, idx):
+        input_ids = torch.from_numpy(self.input_ids[self.offsets[idx]:self.offsets[idx + 1]]).long()
         return {
-            "input_ids": encoding["input_ids"].squeeze(),
-            "attention_mask": encoding["attention_mask"].squeeze(),
-            "labels": labels
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+            "labels": torch.from_numpy(self.labels[idx])
         }
 
+def is_main_process():
+    """True outside DDP and on rank 0; only this process logs and saves."""
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+def log(*args, **kwargs):
+    """print() on the main process only."""
+    if is_main_process():
+        print(*args, **kwargs)
+
 # ============================================================================
 # METRICS - Proper multilabel metrics
 # ============================================================================
@@ -132,61 +186,76 @@ def compute_metrics(preds, labels):
 # ============================================================================
 # TRAINING WITH AMP
 # ============================================================================
-def train_epoch(model, loader, optimizer, scheduler, scaler, device, accumulation_steps):
+def train_epoch(model, loader, optimizer, scheduler, scaler, device, accumulation_steps,
+                amp_dtype=torch.float16):
     model.train()
     total_loss = 0
-    optimizer.zero_grad()
+    running = torch.zeros((), device=device)  # Summed on device; synced at boundaries only
+    is_ddp = hasattr(model, "no_sync")
+    optimizer.zero_grad(set_to_none=True)
     
-    pbar = tqdm(loader, desc="Training")
+    pbar = tqdm(loader, desc="Training", disable=not is_main_process())
     for step, batch in enumerate(pbar):
-        with autocast():  # Mixed precision
-            outputs = model(
-                input_ids=batch["input_ids"].to(device),
-                attention_mask=batch["attention_mask"].to(device),
-                labels=batch["labels"].to(device)
-            )
-            loss = outputs.loss / accumulation_steps
-        
-        scaler.scale(loss).backward()
+        is_boundary = (step + 1) % accumulation_steps == 0
+        # Under DDP, all-reduce gradients only on the step that updates weights
+        ctx = model.no_sync() if is_ddp and not is_boundary else contextlib.nullcontext()
+        with ctx:
+            with autocast("cuda", enabled=device.type == "cuda", dtype=amp_dtype):  # Mixed precision
+                outputs = model(
+                    input_ids=batch["input_ids"].to(device, non_blocking=True),
+                    attention_mask=batch["attention_mask"].to(device, non_blocking=True),
+                    labels=batch["labels"].to(device, non_blocking=True)
+                )
+                loss = outputs.loss / accumulation_steps
+            
+            scaler.scale(loss).backward()
+        running += loss.detach() * accumulation_steps
         
-        if (step + 1) % accumulation_steps == 0:
+        if is_boundary:
             scaler.unscale_(optimizer)
             torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            scale = scaler.get_scale()
             scaler.step(optimizer)
             scaler.update()
-            scheduler.step()
-            optimizer.zero_grad()
-        
-        total_loss += loss.item() * accumulation_steps
-        pbar.set_postfix({"loss": f"{loss.item() * accumulation_steps:.4f}"})
+            # A lowered scale means inf/NaN grads and a skipped optimizer step;
+            # don't advance the LR schedule for it
+            if scaler.get_scale() >= scale:
+                scheduler.step()
+            optimizer.zero_grad(set_to_none=True)
+            
+            val = running.item()
+            total_loss += val
+            running.zero_()
+            pbar.set_postfix({"loss": f"{val / accumulation_steps:.4f}"})
     
+    total_loss += running.item()  # Leftover micro-steps after the last boundary
     return total_loss / len(loader)
 
-def evaluate(model, loader, device):
+def evaluate(model, loader, device, amp_dtype=torch.float16):
     model.eval()
-    total_loss = 0
+    total_loss = torch.zeros((), device=device)
     all_preds = []
     all_labels = []
     
-    with torch.no_grad():
-        for batch in tqdm(loader, desc="Evaluating"):
-            with autocast():
+    # Predictions stay on the device until the end: one sync instead of one per batch
+    with torch.inference_mode():
+        for batch in tqdm(loader, desc="Evaluating", disable=not is_main_process()):
+            with autocast("cuda", enabled=device.type == "cuda", dtype=amp_dtype):
                 outputs = model(
-                    input_ids=batch["input_ids"].to(device),
-                    attention_mask=batch["attention_mask"].to(device),
-                    labels=batch["labels"].to(device)
+                    input_ids=batch["input_ids"].to(device, non_blocking=True),
+                    attention_mask=batch["attention_mask"].to(device, non_blocking=True),
+                    labels=batch["labels"].to(device, non_blocking=True)
                 )
-            total_loss += outputs.loss.item()
+            total_loss += outputs.loss.float()
             
-            preds = torch.sigmoid(outputs.logits).cpu().numpy()
-            all_preds.append(preds)
-            all_labels.append(batch["labels"].numpy())
+            all_preds.append(torch.sigmoid(outputs.logits).float())
+            all_labels.append(batch["labels"])  # Still on the CPU
     
-    all_preds = np.concatenate(all_preds)
-    all_labels = np.concatenate(all_labels)
+    all_preds = torch.cat(all_preds).cpu().numpy()
+    all_labels = torch.cat(all_labels).numpy()
     
     metrics = compute_metrics(all_preds, all_labels)
-    metrics["loss"] = total_loss / len(loader)
+    metrics["loss"] = total_loss.item() / len(loader)
     
     return metrics
 
@@ -194,136 +263,230 @@ def evaluate(model, loader, device):
 # MAIN
 # ============================================================================
 def main():
-    print("=" * 70)
-    print("  LEMMA MathBERT Training - FIXED VERSION")
-    print("  Pretrained BERT | AMP | Proper Metrics")
-    print("=" * 70)
-    
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print(f"\n🖥️  Device: {device}")
+    # torchrun sets LOCAL_RANK; one process per GPU
+    distributed = "LOCAL_RANK" in os.environ
+    if distributed:
+        dist.init_process_group("nccl")
+        local_rank = int(os.environ["LOCAL_RANK"])
+        torch.cuda.set_device(local_rank)
+    
+    log("=" * 70)
+    log("  LEMMA MathBERT Training - FIXED VERSION")
+    log("  Pretrained BERT | AMP | Proper Metrics")
+    log("=" * 70)
+    
+    # TF32 Tensor Core matmuls for the remaining FP32 ops (Ampere+)
+    torch.set_float32_matmul_precision("high")
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    # Autotuning only pays off when shapes are static (max_length padding)
+    torch.backends.cudnn.benchmark = not CONFIG["dynamic_padding"]
+    
+    if distributed:
+        device = torch.device("cuda", local_rank)
+    else:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    world_size = dist.get_world_size() if distributed else 1
+    log(f"\n🖥️  Device: {device} (world size {world_size})")
     if device.type == "cuda":
-        print(f"   GPU: {torch.cuda.get_device_name(0)}")
-        print(f"   Memory: {torch.cuda.get_device_properties(0).total_memory / 1e9:.1f} GB")
+        log(f"   GPU: {torch.cuda.get_device_name(device)}")
+        log(f"   Memory: {torch.cuda.get_device_properties(device).total_memory / 1e9:.1f} GB")
     
     # Load data
-    print("\n📂 Loading data...")
+    log("\n📂 Loading data...")
     data_file = "synthetic_1000000.json"
     if not os.path.exists(data_file):
         data_file = "data/synthetic_1000000.json"
     
-    with open(data_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    print(f"   Loaded {len(data):,} problems")
+    data = load_problems(data_file)
+    log(f"   Loaded {len(data):,} problems")
     
     if CONFIG["max_samples"]:
-        import random
-        random.seed(42)
-        data = random.sample(data, min(CONFIG["max_samples"], len(data)))
-        print(f"   Subsampled to {len(data):,}")
+        rng = np.random.default_rng(42)
+        keep = rng.choice(len(data), min(CONFIG["max_samples"], len(data)), replace=False)
+        data = [data[i] for i in keep]
+        log(f"   Subsampled to {len(data):,}")
     
     # Load PRETRAINED model (not random init!)
-    print(f"\n🧠 Loading pretrained {CONFIG['model_name']}...")
+    log(f"\n🧠 Loading pretrained {CONFIG['model_name']}...")
     tokenizer = AutoTokenizer.from_pretrained(CONFIG["model_name"])
     model = BertForSequenceClassification.from_pretrained(
         CONFIG["model_name"],
         num_labels=len(VOCAB),
-        problem_type="multi_label_classification"
+        problem_type="multi_label_classification",
+        attn_implementation="sdpa"  # Fused scaled_dot_product_attention kernels
     )
     model.to(device)
     
     total_params = sum(p.numel() for p in model.parameters())
-    print(f"   Parameters: {total_params:,}")
-    print(f"   ✓ PRETRAINED weights loaded (not random init)")
+    log(f"   Parameters: {total_params:,}")
+    log(f"   ✓ PRETRAINED weights loaded (not random init)")
+    log(f"   ✓ Attention: {model.config._attn_implementation}")
+    
+    # DDP and compiled wrappers share parameters with `model`; the eager module
+    # is kept for saving. CUDA graphs (reduce-overhead) need the static shapes of
+    # max_length padding + drop_last; dynamic padding compiles for dynamic shapes.
+    train_model = model
+    if distributed:
+        train_model = DDP(
+            model,
+            device_ids=[local_rank],
+            bucket_cap_mb=CONFIG["bucket_cap_mb"],
+            gradient_as_bucket_view=True,
+            static_graph=True,
+        )
+        log(f"   ✓ DistributedDataParallel over {world_size} GPUs")
+    if CONFIG["compile"] and device.type == "cuda":
+        if CONFIG["dynamic_padding"]:
+            train_model = torch.compile(train_model, dynamic=True)
+            log(f"   ✓ torch.compile enabled (dynamic shapes)")
+        else:
+            train_model = torch.compile(train_model, mode="reduce-overhead", dynamic=False)
+            log(f"   ✓ torch.compile enabled (reduce-overhead)")
     
     # Split
     train_data, val_data = train_test_split(data, test_size=0.05, random_state=42)
-    print(f"\n📊 Train: {len(train_data):,}, Val: {len(val_data):,}")
-    
-    # Datasets
-    train_dataset = MathDataset(train_data, tokenizer, VOCAB, CONFIG["max_length"])
-    val_dataset = MathDataset(val_data, tokenizer, VOCAB, CONFIG["max_length"])
+    log(f"\n📊 Train: {len(train_data):,}, Val: {len(val_data):,}")
+    
+    # Datasets (tokenized once, then cached to disk)
+    # Cache key covers everything that changes the tokenized arrays
+    cache_key = hashlib.sha1(
+        f"{CONFIG['model_name']}:{CONFIG['max_length']}:{CONFIG['max_samples']}:"
+        f"{os.path.getmtime(data_file)}:{VOCAB}".encode()
+    ).hexdigest()[:12]
+    cache_prefix = f"{CONFIG['cache_dir']}/fixed_{cache_key}"
+    
+    # Under DDP rank 0 builds the cache while the other ranks wait, then load it
+    if not is_main_process():
+        dist.barrier()
+    train_dataset = MathDataset(
+        train_data, tokenizer, VOCAB, CONFIG["max_length"], cache_prefix=f"{cache_prefix}_train"
+    )
+    val_dataset = MathDataset(
+        val_data, tokenizer, VOCAB, CONFIG["max_length"], cache_prefix=f"{cache_prefix}_val"
+    )
+    if distributed and is_main_process():
+        dist.barrier()
+    
+    # Each rank gets its own shard of the training batches
+    rank = dist.get_rank() if distributed else 0
+    if CONFIG["dynamic_padding"]:
+        collate = DataCollatorWithPadding(tokenizer, pad_to_multiple_of=8, return_tensors="pt")
+        # Similar lengths per batch keep the padding added by the collator small
+        train_sampler = LengthGroupedBatchSampler(
+            train_dataset.lengths, CONFIG["batch_size"], num_replicas=world_size, rank=rank
+        )
+        batching = {"batch_sampler": train_sampler}
+    else:
+        collate = DataCollatorWithPadding(
+            tokenizer, padding="max_length", max_length=CONFIG["max_length"], return_tensors="pt"
+        )
+        train_sampler = DistributedSampler(
+            train_dataset, num_replicas=world_size, rank=rank, shuffle=True, drop_last=True
+        )
+        batching = {"batch_size": CONFIG["batch_size"], "sampler": train_sampler, "drop_last": True}
     
     train_loader = DataLoader(
         train_dataset, 
-        batch_size=CONFIG["batch_size"], 
-        shuffle=True, 
+        **batching,
         num_workers=CONFIG["num_workers"],
         pin_memory=True,
-        persistent_workers=True
+        persistent_workers=True,
+        prefetch_factor=CONFIG["prefetch_factor"],
+        worker_init_fn=worker_init_fn,
+        collate_fn=collate
     )
     val_loader = DataLoader(
         val_dataset, 
         batch_size=CONFIG["batch_size"] * 2,  # Bigger for eval
         num_workers=CONFIG["num_workers"],
-        pin_memory=True
+        pin_memory=True,
+        persistent_workers=True,
+        prefetch_factor=CONFIG["prefetch_factor"],
+        worker_init_fn=worker_init_fn,
+        collate_fn=collate
     )
     
     # Optimizer with AMP
     optimizer = torch.optim.AdamW(
         model.parameters(), 
         lr=CONFIG["learning_rate"],
-        weight_decay=CONFIG["weight_decay"]
+        weight_decay=CONFIG["weight_decay"],
+        fused=device.type == "cuda"  # Single fused kernel for the parameter update
     )
-    scaler = GradScaler()  # For AMP
     
-    effective_batch = CONFIG["batch_size"] * CONFIG["gradient_accumulation"]
+    # AMP: bf16 on Ampere+ (no loss scaling needed), fp16 + GradScaler otherwise
+    use_bf16 = device.type == "cuda" and torch.cuda.is_bf16_supported()
+    amp_dtype = torch.bfloat16 if use_bf16 else torch.float16
+    scaler = GradScaler("cuda", enabled=device.type == "cuda" and not use_bf16)
+    
+    effective_batch = CONFIG["batch_size"] * CONFIG["gradient_accumulation"] * world_size
     steps_per_epoch = len(train_loader) // CONFIG["gradient_accumulation"]
     total_steps = steps_per_epoch * CONFIG["epochs"]
     warmup_steps = int(total_steps * CONFIG["warmup_ratio"])
     
     scheduler = get_cosine_schedule_with_warmup(optimizer, warmup_steps, total_steps)
     
-    print(f"\n⚙️  Training Configuration:")
-    print(f"   Epochs: {CONFIG['epochs']}")
-    print(f"   Batch size: {CONFIG['batch_size']} x {CONFIG['gradient_accumulation']} = {effective_batch}")
-    print(f"   Steps per epoch: {steps_per_epoch:,}")
-    print(f"   Total steps: {total_steps:,}")
-    print(f"   ✓ Mixed Precision (AMP) enabled")
-    print(f"   ✓ Gradient accumulation enabled")
+    log(f"\n⚙️  Training Configuration:")
+    log(f"   Epochs: {CONFIG['epochs']}")
+    log(f"   Batch size: {CONFIG['batch_size']} x {CONFIG['gradient_accumulation']} x {world_size} GPU(s) = {effective_batch}")
+    log(f"   Steps per epoch: {steps_per_epoch:,}")
+    log(f"   Total steps: {total_steps:,}")
+    log(f"   ✓ Mixed Precision (AMP) enabled ({'bf16' if use_bf16 else 'fp16'})")
+    log(f"   ✓ Gradient accumulation enabled")
     
     # Training
-    print("\n" + "=" * 70)
-    print("  TRAINING START")
-    print("=" * 70)
+    log("\n" + "=" * 70)
+    log("  TRAINING START")
+    log("=" * 70)
     
     best_f1 = 0
     history = []
     
     for epoch in range(1, CONFIG["epochs"] + 1):
-        print(f"\n{'─' * 70}")
-        print(f"Epoch {epoch}/{CONFIG['epochs']}")
-        print('─' * 70)
+        log(f"\n{'─' * 70}")
+        log(f"Epoch {epoch}/{CONFIG['epochs']}")
+        log('─' * 70)
         
+        train_sampler.set_epoch(epoch)  # New shuffle each epoch, same on every rank
         train_loss = train_epoch(
-            model, train_loader, optimizer, scheduler, scaler, 
-            device, CONFIG["gradient_accumulation"]
+            train_model, train_loader, optimizer, scheduler, scaler, 
+            device, CONFIG["gradient_accumulation"], amp_dtype
         )
-        val_metrics = evaluate(model, val_loader, device)
+        val_metrics = evaluate(train_model, val_loader, device, amp_dtype)
         
         history.append({"epoch": epoch, "train_loss": train_loss, **val_metrics})
         
-        print(f"\n📈 Results:")
-        print(f"   Train Loss: {train_loss:.4f}")
-        print(f"   Val Loss: {val_metrics['loss']:.4f}")
-        print(f"   Micro F1: {val_metrics['micro_f1']:.4f}")
-        print(f"   Macro F1: {val_metrics['macro_f1']:.4f}")
-        print(f"   Precision: {val_metrics['precision']:.4f}")
-        print(f"   Recall: {val_metrics['recall']:.4f}")
+        log(f"\n📈 Results:")
+        log(f"   Train Loss: {train_loss:.4f}")
+        log(f"   Val Loss: {val_metrics['loss']:.4f}")
+        log(f"   Micro F1: {val_metrics['micro_f1']:.4f}")
+        log(f"   Macro F1: {val_metrics['macro_f1']:.4f}")
+        log(f"   Precision: {val_metrics['precision']:.4f}")
+        log(f"   Recall: {val_metrics['recall']:.4f}")
         
         # Save checkpoint (throttled)
-        if epoch % CONFIG["save_every_n_epochs"] == 0:
+        if epoch % CONFIG["save_every_n_epochs"] == 0 and is_main_process():
             checkpoint_dir = f"{CONFIG['output_dir']}/checkpoint-{epoch}"
             os.makedirs(checkpoint_dir, exist_ok=True)
             torch.save(model.state_dict(), f"{checkpoint_dir}/model.pt")
-            print(f"   💾 Checkpoint saved")
+            log(f"   💾 Checkpoint saved")
         
-        # Save best (by F1, not loss)
+        # Save best (by F1, not loss). Every rank evaluates the full val set, so
+        # all of them agree on best_f1.
         if val_metrics["micro_f1"] > best_f1:
             best_f1 = val_metrics["micro_f1"]
-            os.makedirs(CONFIG["output_dir"], exist_ok=True)
-            model.save_pretrained(CONFIG["output_dir"])
-            tokenizer.save_pretrained(CONFIG["output_dir"])
-            print(f"   ⭐ New best model (F1: {best_f1:.4f})")
+            if is_main_process():
+                os.makedirs(CONFIG["output_dir"], exist_ok=True)
+                model.save_pretrained(CONFIG["output_dir"])
+                tokenizer.save_pretrained(CONFIG["output_dir"])
+                log(f"   ⭐ New best model (F1: {best_f1:.4f})")
+    
+    is_main = is_main_process()
+    if distributed:
+        dist.destroy_process_group()
+    if not is_main:
+        return
     
     # Save history and vocab
     with open(f"{CONFIG['output_dir']}/history.json", "w") as f:
@@ -0,0 +1,140 @@
+"""
+Helpers shared by the LEMMA training scripts.
+
+The Colab/torchrun scripts import this module, so upload it next to them
+(e.g. train_common.py alongside train_mathbert.py) when running on Colab.
+"""
+
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+def load_problems(path):
+    """Load the problem JSON, using orjson (SIMD parser, ~3-6x faster) if installed."""
+    try:
+        import orjson
+    except ImportError:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
+
+def worker_init_fn(_):
+    """Keep each DataLoader worker single-threaded to avoid CPU oversubscription."""
+    torch.set_num_threads(1)
+
+class LengthGroupedBatchSampler(Sampler):
+    """Yields batches of similar-length samples so dynamic padding adds few pad tokens.
+    
+    Each epoch the indices are shuffled and split into mega-batches of
+    `mega_batches` batches; every mega-batch is sorted by length and cut into
+    batches, and the order of all batches is shuffled again. Under DDP every
+    rank builds the same batches from the same seed and keeps every
+    `num_replicas`-th one; call set_epoch() each epoch, as with DistributedSampler.
+    """
+    
+    def __init__(self, lengths, batch_size, mega_batches=50, drop_last=True, seed=42,
+                 num_replicas=1, rank=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.mega_batches = mega_batches
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+    
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+    
+    def __len__(self):
+        if self.drop_last:
+            num_batches = len(self.lengths) // self.batch_size
+        else:
+            num_batches = -(-len(self.lengths) // self.batch_size)
+        return num_batches // self.num_replicas
+    
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        
+        indices = rng.permutation(len(self.lengths))
+        mega_size = self.batch_size * self.mega_batches
+        batches = []
+        for start in range(0, len(indices), mega_size):
+            chunk = indices[start:start + mega_size]
+            chunk = chunk[np.argsort(-self.lengths[chunk], kind="stable")]
+            batches.extend(chunk[i:i + self.batch_size] for i in range(0, len(chunk), self.batch_size))
+        if self.drop_last:
+            batches = [b for b in batches if len(b) == self.batch_size]
+        
+        # Same number of batches on every rank, so DDP collectives stay in step
+        order = rng.permutation(len(batches))[:len(self) * self.num_replicas]
+        for i in order[self.rank::self.num_replicas]:
+            yield batches[i].tolist()
+
+class LogitsOnly(torch.nn.Module):
+    """Encoder + classifier returning logits only.
+    
+    The loss (and the HF labels/problem_type branching) stays outside, so the
+    wrapped forward compiles as a single graph with fullgraph=True.
+    """
+    
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+    
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask).logits
+
+def export_onnx(model, tokenizer, path, max_length):
+    """Export with the TorchDynamo exporter (dynamic batch and sequence axes, graph
+    optimization), falling back to the legacy TorchScript exporter on older PyTorch."""
+    # Two texts of different lengths, padded together: torch.export specializes
+    # size-1 dims, so a single-text dummy would pin the batch axis to a constant
+    inputs = tokenizer(
+        ["Find all functions f: R -> R such that f(x + y) = f(x) + f(y).", "Prove that a + b >= 2."],
+        return_tensors="pt", padding=True, max_length=max_length, truncation=True,
+    )
+    args = (inputs["input_ids"], inputs["attention_mask"])
+    names = dict(input_names=["input_ids", "attention_mask"], output_names=["logits"])
+    try:
+        batch, seq = torch.export.Dim("batch"), torch.export.Dim("seq")
+        torch.onnx.export(
+            model, args, path, **names,
+            dynamo=True,
+            optimize=True,
+            opset_version=17,
+            dynamic_shapes={"input_ids": {0: batch, 1: seq}, "attention_mask": {0: batch, 1: seq}},
+        )
+    except (AttributeError, TypeError, ImportError) as e:
+        # Old PyTorch (no torch.export / dynamo=) or onnxscript not installed;
+        # genuine export errors from the dynamo path are not swallowed
+        print(f"Dynamo ONNX export unavailable ({e}), using the legacy exporter")
+        torch.onnx.export(
+            model, args, path, **names,
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "seq"},
+                "attention_mask": {0: "batch", 1: "seq"},
+                "logits": {0: "batch"},
+            },
+            opset_version=14,
+        )
+
+def quantize_onnx(onnx_path):
+    """Write a dynamically quantized INT8 copy (~4x smaller) for CPU inference."""
+    try:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+    except ImportError:
+        print("pip install onnxruntime to also write an INT8 model")
+        return
+    try:
+        int8_path = onnx_path.replace(".onnx", "_int8.onnx")
+        quantize_dynamic(onnx_path, int8_path, weight_type=QuantType.QInt8, per_channel=True)
+        size_mb = os.path.getsize(int8_path) / (1024 * 1024)
+        print(f"INT8 ONNX model saved to {int8_path} ({size_mb:.1f} MB)")
+        print("INT8 is only faster on CPUs with VNNI (AVX512-VNNI / AVX-VNNI); keep the FP32 model otherwise")
+    except Exception as e:
+        print(f"INT8 quantization failed, keeping the FP32 model only: {e}")
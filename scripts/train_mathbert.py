@@ -3,7 +3,7 @@ MathBERT Training Script for LEMMA
 Uses verified_imo_problems.json
 
 Usage in Google Colab:
-1. Upload this script and data/verified_imo_problems.json
+1. Upload this script, train_common.py and data/verified_imo_problems.json
 2. Run: !pip install transformers torch scikit-learn onnx onnxruntime onnxscript -q
 3. Run all cells
 4. Download lemma_model.zip
@@ -18,6 +18,8 @@ import numpy as np
 import json
 import os
 
+from train_common import export_onnx, quantize_onnx, worker_init_fn
+
 VOCAB = [
     "x = 0", "y = 0", "x = y", "x = 1", "y = 1",
     "a = b = c = 1", "abc = 1 constraint", "Apply AM-GM", "Apply Cauchy-Schwarz",
@@ -35,44 +37,50 @@ CONFIG = {
     "learning_rate": 5e-5,  
     "warmup_ratio": 0.06,
     "patience": 4,
+    "num_workers": min(8, os.cpu_count() or 1),
+    "prefetch_factor": 4,
     "output_dir": "lemma_model",
 }
 
 class IMODataset(Dataset):
     def __init__(self, data, tokenizer, vocab, max_length=256):
-        self.data = data
         self.tokenizer = tokenizer
         self.vocab_to_idx = {v: i for i, v in enumerate(vocab)}
         self.max_length = max_length
         
+        # Batch-tokenize once up front instead of once per __getitem__
+        encoding = tokenizer([item["statement"] for item in data], max_length=max_length, padding="max_length", truncation=True, return_tensors="np")
+        self.input_ids = encoding["input_ids"].astype(np.int32)
+        self.attention_mask = encoding["attention_mask"].astype(np.int8)
+        
+        # Multi-label targets: collect (row, col) pairs, then one vectorized scatter
+        rows, cols = [], []
+        for i, item in enumerate(data):
+            for sub in item["subs"]:
+                j = self.vocab_to_idx.get(sub)
+                if j is not None:
+                    rows.append(i)
+                    cols.append(j)
+        self.labels = np.zeros((len(data), len(self.vocab_to_idx)), dtype=np.float32)
+        self.labels[rows, cols] = 1.0
+        
     def __len__(self):
-        return len(self.data)
+        return len(self.labels)
     
     def __getitem__(self, idx):
-        item = self.data[idx]
-        text = item["statement"]
-        subs = item["subs"]
-        
-        encoding = self.tokenizer(text, max_length=self.max_length, padding="max_length", truncation=True, return_tensors="pt")
-        
-        label = torch.zeros(len(self.vocab_to_idx))
-        for sub in subs:
-            if sub in self.vocab_to_idx:
-                label[self.vocab_to_idx[sub]] = 1.0
-                
         return {
-            "input_ids": encoding["input_ids"].squeeze(),
-            "attention_mask": encoding["attention_mask"].squeeze(),
-            "labels": label
+            "input_ids": torch.from_numpy(self.input_ids[idx]).long(),
+            "attention_mask": torch.from_numpy(self.attention_mask[idx]).long(),
+            "labels": torch.from_numpy(self.labels[idx])
         }
 
 def train_epoch(model, loader, optimizer, scheduler, device):
     model.train()
     total_loss = 0
     for batch in loader:
-        optimizer.zero_grad()
-        outputs = model(input_ids=batch["input_ids"].to(device), attention_mask=batch["attention_mask"].to(device))
-        loss = nn.BCEWithLogitsLoss()(outputs.logits, batch["labels"].to(device))
+        optimizer.zero_grad(set_to_none=True)
+        outputs = model(input_ids=batch["input_ids"].to(device, non_blocking=True), attention_mask=batch["attention_mask"].to(device, non_blocking=True))
+        loss = nn.BCEWithLogitsLoss()(outputs.logits, batch["labels"].to(device, non_blocking=True))
         loss.backward()
         torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
         optimizer.step()
@@ -85,11 +93,11 @@ def evaluate(model, loader, device):
     total_loss, correct, total = 0, 0, 0
     with torch.no_grad():
         for batch in loader:
-            outputs = model(input_ids=batch["input_ids"].to(device), attention_mask=batch["attention_mask"].to(device))
-            loss = nn.BCEWithLogitsLoss()(outputs.logits, batch["labels"].to(device))
+            outputs = model(input_ids=batch["input_ids"].to(device, non_blocking=True), attention_mask=batch["attention_mask"].to(device, non_blocking=True))
+            loss = nn.BCEWithLogitsLoss()(outputs.logits, batch["labels"].to(device, non_blocking=True))
             total_loss += loss.item()
             preds = (torch.sigmoid(outputs.logits) > 0.5).float()
-            correct += (preds == batch["labels"].to(device)).all(dim=1).sum().item()
+            correct += (preds == batch["labels"].to(device, non_blocking=True)).all(dim=1).sum().item()
             total += len(batch["labels"])
     return {"loss": total_loss / len(loader), "accuracy": correct / total}
 
@@ -98,6 +106,12 @@ def main():
     print("LEMMA MathBERT Training")
     print("="*60)
     
+    # TF32 Tensor Core matmuls for the remaining FP32 ops (Ampere+)
+    torch.set_float32_matmul_precision("high")
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True  # Shapes are static (max_length padding)
+    
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"Device: {device}")
     
@@ -107,22 +121,23 @@ def main():
     
     try:
         tokenizer = AutoTokenizer.from_pretrained(CONFIG["model_name"])
-        model = AutoModelForSequenceClassification.from_pretrained(CONFIG["model_name"], num_labels=len(VOCAB), problem_type="multi_label_classification")
+        model = AutoModelForSequenceClassification.from_pretrained(CONFIG["model_name"], num_labels=len(VOCAB), problem_type="multi_label_classification", attn_implementation="sdpa")
         print(f"Using: {CONFIG['model_name']}")
     except:
         print(f"MathBERT unavailable, using {CONFIG['fallback_model']}")
         tokenizer = AutoTokenizer.from_pretrained(CONFIG["fallback_model"])
-        model = AutoModelForSequenceClassification.from_pretrained(CONFIG["fallback_model"], num_labels=len(VOCAB), problem_type="multi_label_classification")
+        model = AutoModelForSequenceClassification.from_pretrained(CONFIG["fallback_model"], num_labels=len(VOCAB), problem_type="multi_label_classification", attn_implementation="sdpa")
     
     model.to(device)
     
     train_data, val_data = train_test_split(data, test_size=0.2, random_state=42)
     print(f"Train: {len(train_data)}, Val: {len(val_data)}")
     
-    train_loader = DataLoader(IMODataset(train_data, tokenizer, VOCAB, CONFIG["max_length"]), batch_size=CONFIG["batch_size"], shuffle=True)
-    val_loader = DataLoader(IMODataset(val_data, tokenizer, VOCAB, CONFIG["max_length"]), batch_size=CONFIG["batch_size"])
+    loader_kwargs = dict(num_workers=CONFIG["num_workers"], pin_memory=True, persistent_workers=True, prefetch_factor=CONFIG["prefetch_factor"], worker_init_fn=worker_init_fn)
+    train_loader = DataLoader(IMODataset(train_data, tokenizer, VOCAB, CONFIG["max_length"]), batch_size=CONFIG["batch_size"], shuffle=True, **loader_kwargs)
+    val_loader = DataLoader(IMODataset(val_data, tokenizer, VOCAB, CONFIG["max_length"]), batch_size=CONFIG["batch_size"], **loader_kwargs)
     
-    optimizer = torch.optim.AdamW(model.parameters(), lr=CONFIG["learning_rate"])
+    optimizer = torch.optim.AdamW(model.parameters(), lr=CONFIG["learning_rate"], fused=device.type == "cuda")
     scheduler = get_cosine_schedule_with_warmup(optimizer, num_warmup_steps=int(len(train_loader) * CONFIG["epochs"] * CONFIG["warmup_ratio"]), num_training_steps=len(train_loader) * CONFIG["epochs"])
     
     best_acc, patience_counter = 0, 0
@@ -151,9 +166,13 @@ def main():
     tokenizer.save_pretrained(CONFIG["output_dir"])
     
     print("\nExporting to ONNX...")
-    model.eval().cpu()
-    dummy = tokenizer("Find all functions", return_tensors="pt", max_length=CONFIG["max_length"], truncation=True, padding="max_length")
-    torch.onnx.export(model, (dummy["input_ids"], dummy["attention_mask"]), f"{CONFIG['output_dir']}/substitution_model.onnx", input_names=["input_ids", "attention_mask"], output_names=["logits"], opset_version=14)
+    try:
+        model.eval().cpu()
+        export_onnx(model, tokenizer, f"{CONFIG['output_dir']}/substitution_model.onnx", CONFIG["max_length"])
+        print(f"✓ ONNX model saved to {CONFIG['output_dir']}/substitution_model.onnx")
+        quantize_onnx(f"{CONFIG['output_dir']}/substitution_model.onnx")
+    except Exception as e:
+        print(f"ONNX export failed: {e}")
     
     print(f"\nDone! Best accuracy: {best_acc*100:.1f}%")
     print(f"Model saved to {CONFIG['output_dir']}/")
@@ -6,21 +6,28 @@ Trains substitution prediction model on synthetic_1000000.json
 Usage:
   python train_on_synthetic.py
 
-For GPU (Google Colab):
-  !pip install transformers torch accelerate -q
+For GPU (Google Colab), with train_common.py uploaded next to this script:
+  !pip install transformers torch accelerate orjson onnxruntime -q
   python train_on_synthetic.py
 """
 
 import torch
 import torch.nn as nn
 from torch.utils.data import Dataset, DataLoader
-from transformers import AutoTokenizer, AutoModelForSequenceClassification, get_cosine_schedule_with_warmup
+from transformers import (
+    AutoTokenizer,
+    AutoModelForSequenceClassification,
+    DataCollatorWithPadding,
+    get_cosine_schedule_with_warmup
+)
 from sklearn.model_selection import train_test_split
 import numpy as np
-import json
+import hashlib
 import os
 from tqdm import tqdm
 
+from train_common import LengthGroupedBatchSampler, export_onnx, load_problems, quantize_onnx, worker_init_fn
+
 # Substitution vocabulary (must match Rust SubstitutionPredictor)
 VOCAB = [
     "x = 0", "y = 0", "x = y", "x = 1", "y = 1",
@@ -38,44 +45,73 @@ CONFIG = {
     "learning_rate": 2e-5,
     "warmup_ratio": 0.1,
     "max_samples": 100000,  # Train on 100K for speed (use None for all 1M)
+    "dynamic_padding": True,  # Pad to longest in a length-grouped batch instead of max_length
+    "compile": True,  # torch.compile on CUDA (CUDA graphs only with static padding)
+    "num_workers": min(8, os.cpu_count() or 1),
+    "prefetch_factor": 4,
     "output_dir": "model/mathbert_synthetic",
+    "cache_dir": ".cache",  # Tokenized arrays, reused across runs
 }
 
 class SyntheticDataset(Dataset):
-    def __init__(self, data, tokenizer, vocab, max_length=256):
-        self.data = data
+    """Pre-tokenized dataset: tokenization runs once here, not per __getitem__.
+    
+    Token ids are kept unpadded in one flat int32 array indexed by per-sample
+    offsets; padding is left to the DataLoader collator. With `cache_prefix`
+    the arrays are saved as .npy files and memory-mapped on later runs.
+    """
+    
+    CACHE_FIELDS = ("input_ids", "offsets", "labels")
+    
+    def __init__(self, data, tokenizer, vocab, max_length=256, chunk_size=10000, cache_prefix=None):
         self.tokenizer = tokenizer
         self.vocab_to_idx = {v: i for i, v in enumerate(vocab)}
         self.max_length = max_length
         
-    def __len__(self):
-        return len(self.data)
-    
-    def __getitem__(self, idx):
-        item = self.data[idx]
-        text = item["statement"]
+        # "labels" is written last, so its presence marks a complete cache
+        if cache_prefix and os.path.exists(f"{cache_prefix}.labels.npy"):
+            for field in self.CACHE_FIELDS:
+                # Copy-on-write mapping: pages load lazily and are shared by workers
+                setattr(self, field, np.load(f"{cache_prefix}.{field}.npy", mmap_mode="c"))
+            self.lengths = np.diff(self.offsets)
+            return
         
-        # Get substitutions from data
-        subs = item.get("substitutions", [])
+        # Batch-tokenize once up front; padding is left to the DataLoader collator
+        input_ids = []
+        for start in range(0, len(data), chunk_size):
+            texts = [item["statement"] for item in data[start:start + chunk_size]]
+            encoding = self.tokenizer(texts, max_length=max_length, truncation=True)
+            input_ids.extend(np.asarray(ids, dtype=np.int32) for ids in encoding["input_ids"])
+        self.lengths = np.array([len(ids) for ids in input_ids], dtype=np.int64)
+        self.offsets = np.zeros(len(data) + 1, dtype=np.int64)
+        np.cumsum(self.lengths, out=self.offsets[1:])
+        self.input_ids = np.concatenate(input_ids) if input_ids else np.zeros(0, dtype=np.int32)
         
-        # Create multi-label target
-        labels = torch.zeros(len(self.vocab_to_idx))
-        for sub in subs:
-            if sub in self.vocab_to_idx:
-                labels[self.vocab_to_idx[sub]] = 1.0
+        # Multi-label targets: collect (row, col) pairs, then one vectorized scatter
+        rows, cols = [], []
+        for i, item in enumerate(data):
+            for sub in item.get("substitutions", []):
+                j = self.vocab_to_idx.get(sub)
+                if j is not None:
+                    rows.append(i)
+                    cols.append(j)
+        self.labels = np.zeros((len(data), len(self.vocab_to_idx)), dtype=np.float32)
+        self.labels[rows, cols] = 1.0
         
-        encoding = self.tokenizer(
-            text,
-            max_length=self.max_length,
-            padding="max_length",
-            truncation=True,
-            return_tensors="pt"
-        )
+        if cache_prefix:
+            os.makedirs(os.path.dirname(cache_prefix) or ".", exist_ok=True)
+            for field in self.CACHE_FIELDS:
+                np.save(f"{cache_prefix}.{field}.npy", getattr(self, field))
         
+    def __len__(self):
+        return len(self.labels)
+    
+    def __getitem__(self, idx):
+        input_ids = torch.from_numpy(self.input_ids[self.offsets[idx]:self.offsets[idx + 1]]).long()
         return {
-            "input_ids": encoding["input_ids"].squeeze(),
-            "attention_mask": encoding["attention_mask"].squeeze(),
-            "labels": labels
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+            "labels": torch.from_numpy(self.labels[idx])
         }
 
 def train_epoch(model, loader, optimizer, scheduler, device):
@@ -84,11 +120,11 @@ def train_epoch(model, loader, optimizer, scheduler, device):
     pbar = tqdm(loader, desc="Training")
     
     for batch in pbar:
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         outputs = model(
-            input_ids=batch["input_ids"].to(device),
-            attention_mask=batch["attention_mask"].to(device),
-            labels=batch["labels"].to(device)
+            input_ids=batch["input_ids"].to(device, non_blocking=True),
+            attention_mask=batch["attention_mask"].to(device, non_blocking=True),
+            labels=batch["labels"].to(device, non_blocking=True)
         )
         loss = outputs.loss
         loss.backward()
@@ -109,13 +145,13 @@ def evaluate(model, loader, device):
     with torch.no_grad():
         for batch in tqdm(loader, desc="Evaluating"):
             outputs = model(
-                input_ids=batch["input_ids"].to(device),
-                attention_mask=batch["attention_mask"].to(device),
-                labels=batch["labels"].to(device)
+                input_ids=batch["input_ids"].to(device, non_blocking=True),
+                attention_mask=batch["attention_mask"].to(device, non_blocking=True),
+                labels=batch["labels"].to(device, non_blocking=True)
             )
             total_loss += outputs.loss.item()
             preds = (torch.sigmoid(outputs.logits) > 0.5).float()
-            correct += (preds == batch["labels"].to(device)).all(dim=1).sum().item()
+            correct += (preds == batch["labels"].to(device, non_blocking=True)).all(dim=1).sum().item()
             total += len(batch["labels"])
     
     return {"loss": total_loss / len(loader), "accuracy": correct / total}
@@ -125,6 +161,13 @@ def main():
     print("MathBERT Training on 1M Synthetic Problems")
     print("=" * 60)
     
+    # TF32 Tensor Core matmuls for the remaining FP32 ops (Ampere+)
+    torch.set_float32_matmul_precision("high")
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    # Autotuning only pays off when shapes are static (max_length padding)
+    torch.backends.cudnn.benchmark = not CONFIG["dynamic_padding"]
+    
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"Device: {device}")
     
@@ -132,15 +175,14 @@ def main():
     data_path = "data/synthetic_1000000.json"
     print(f"Loading {data_path}...")
     
-    with open(data_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    data = load_problems(data_path)
     print(f"Loaded {len(data):,} synthetic problems")
     
     # Subsample for faster training
     if CONFIG["max_samples"] and len(data) > CONFIG["max_samples"]:
-        import random
-        random.seed(42)
-        data = random.sample(data, CONFIG["max_samples"])
+        rng = np.random.default_rng(42)
+        keep = rng.choice(len(data), CONFIG["max_samples"], replace=False)
+        data = [data[i] for i in keep]
         print(f"Subsampled to {len(data):,} problems for training")
     
     # Load model
@@ -149,23 +191,67 @@ def main():
     model = AutoModelForSequenceClassification.from_pretrained(
         CONFIG["model_name"], 
         num_labels=len(VOCAB), 
-        problem_type="multi_label_classification"
+        problem_type="multi_label_classification",
+        attn_implementation="sdpa"  # Fused scaled_dot_product_attention kernels
     )
+    print(f"Attention: {model.config._attn_implementation}")
     model.to(device)
     
+    # Compiled wrapper shares parameters with `model`; the eager module is kept
+    # for save_pretrained/ONNX. CUDA graphs (reduce-overhead) need the static
+    # shapes of max_length padding + drop_last; dynamic padding compiles for dynamic shapes.
+    train_model = model
+    if CONFIG["compile"] and device.type == "cuda":
+        if CONFIG["dynamic_padding"]:
+            train_model = torch.compile(model, dynamic=True)
+            print("torch.compile enabled (dynamic shapes)")
+        else:
+            train_model = torch.compile(model, mode="reduce-overhead", dynamic=False)
+            print("torch.compile enabled (reduce-overhead)")
+    
     # Split data
     train_data, val_data = train_test_split(data, test_size=0.1, random_state=42)
     print(f"Train: {len(train_data):,}, Val: {len(val_data):,}")
     
-    # Create datasets
-    train_dataset = SyntheticDataset(train_data, tokenizer, VOCAB, CONFIG["max_length"])
-    val_dataset = SyntheticDataset(val_data, tokenizer, VOCAB, CONFIG["max_length"])
+    # Create datasets (tokenized once, then cached to disk)
+    # Cache key covers everything that changes the tokenized arrays
+    cache_key = hashlib.sha1(
+        f"{CONFIG['model_name']}:{CONFIG['max_length']}:{CONFIG['max_samples']}:"
+        f"{os.path.getmtime(data_path)}:{VOCAB}".encode()
+    ).hexdigest()[:12]
+    cache_prefix = f"{CONFIG['cache_dir']}/synthetic_{cache_key}"
+    train_dataset = SyntheticDataset(
+        train_data, tokenizer, VOCAB, CONFIG["max_length"], cache_prefix=f"{cache_prefix}_train"
+    )
+    val_dataset = SyntheticDataset(
+        val_data, tokenizer, VOCAB, CONFIG["max_length"], cache_prefix=f"{cache_prefix}_val"
+    )
     
-    train_loader = DataLoader(train_dataset, batch_size=CONFIG["batch_size"], shuffle=True, num_workers=0)
-    val_loader = DataLoader(val_dataset, batch_size=CONFIG["batch_size"], num_workers=0)
+    if CONFIG["dynamic_padding"]:
+        collate = DataCollatorWithPadding(tokenizer, pad_to_multiple_of=8, return_tensors="pt")
+    else:
+        collate = DataCollatorWithPadding(
+            tokenizer, padding="max_length", max_length=CONFIG["max_length"], return_tensors="pt"
+        )
+    loader_kwargs = dict(
+        num_workers=CONFIG["num_workers"],
+        pin_memory=True,
+        persistent_workers=True,
+        prefetch_factor=CONFIG["prefetch_factor"],
+        worker_init_fn=worker_init_fn,
+        collate_fn=collate,
+    )
+    train_sampler = None
+    if CONFIG["dynamic_padding"]:
+        train_sampler = LengthGroupedBatchSampler(train_dataset.lengths, CONFIG["batch_size"])
+        train_loader = DataLoader(train_dataset, batch_sampler=train_sampler, **loader_kwargs)
+    else:
+        train_loader = DataLoader(train_dataset, batch_size=CONFIG["batch_size"], shuffle=True, drop_last=True, **loader_kwargs)
+    val_loader = DataLoader(val_dataset, batch_size=CONFIG["batch_size"], **loader_kwargs)
     
     # Optimizer & scheduler
-    optimizer = torch.optim.AdamW(model.parameters(), lr=CONFIG["learning_rate"])
+    # Fused AdamW: one CUDA kernel for the whole parameter update
+    optimizer = torch.optim.AdamW(model.parameters(), lr=CONFIG["learning_rate"], fused=device.type == "cuda")
     total_steps = len(train_loader) * CONFIG["epochs"]
     warmup_steps = int(total_steps * CONFIG["warmup_ratio"])
     scheduler = get_cosine_schedule_with_warmup(optimizer, warmup_steps, total_steps)
@@ -185,8 +271,10 @@ def main():
         print(f"Epoch {epoch + 1}/{CONFIG['epochs']}")
         print('='*60)
         
-        train_loss = train_epoch(model, train_loader, optimizer, scheduler, device)
-        val_metrics = evaluate(model, val_loader, device)
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)  # New shuffle each epoch
+        train_loss = train_epoch(train_model, train_loader, optimizer, scheduler, device)
+        val_metrics = evaluate(train_model, val_loader, device)
         
         print(f"\nTrain Loss: {train_loss:.4f}")
         print(f"Val Loss: {val_metrics['loss']:.4f}")
@@ -207,17 +295,10 @@ def main():
     # Export to ONNX
     print("\nExporting to ONNX...")
     try:
-        dummy_input = tokenizer("Test problem", return_tensors="pt", padding="max_length", max_length=256)
-        model.eval()
-        torch.onnx.export(
-            model,
-            (dummy_input["input_ids"], dummy_input["attention_mask"]),
-            f"{CONFIG['output_dir']}/substitution_model.onnx",
-            input_names=["input_ids", "attention_mask"],
-            output_names=["logits"],
-            dynamic_axes={"input_ids": {0: "batch"}, "attention_mask": {0: "batch"}, "logits": {0: "batch"}}
-        )
+        model.eval().cpu()
+        export_onnx(model, tokenizer, f"{CONFIG['output_dir']}/substitution_model.onnx", CONFIG["max_length"])
         print(f"✓ ONNX model saved to {CONFIG['output_dir']}/substitution_model.onnx")
+        quantize_onnx(f"{CONFIG['output_dir']}/substitution_model.onnx")
     except Exception as e:
         print(f"ONNX export failed: {e}")
 
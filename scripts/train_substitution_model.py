@@ -8,27 +8,34 @@ Exports model to ONNX for Rust inference.
 Usage:
     python train_substitution_model.py --data annotated_problems.json --output model/
     
+    # Multi-GPU (DDP, one process per GPU; global batch = N x --batch-size)
+    torchrun --nproc_per_node=N train_substitution_model.py --data annotated_problems.json --output model/
+    
 Requirements:
     pip install transformers torch datasets onnx onnxruntime
 """
 
 import json
 import argparse
+import os
+import re
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import accumulate
 from pathlib import Path
-from typing import List, Dict, Tuple
+from typing import List, Dict, Optional, Tuple
 import random
 
 import torch
 from torch.utils.data import Dataset, DataLoader
 from transformers import (
-    DistilBertTokenizer,
+    DistilBertTokenizerFast,
     DistilBertForSequenceClassification,
     DistilBertConfig,
     Trainer,
     TrainingArguments,
     EarlyStoppingCallback,
 )
-from sklearn.preprocessing import MultiLabelBinarizer
 from sklearn.model_selection import train_test_split
 import numpy as np
 
@@ -60,12 +67,54 @@ SUBSTITUTION_VOCAB = [
     "Consider p = 2 separately",
 ]
 
+# Vocabulary matching for _normalize_substitutions, compiled once.
+# _VOCAB_RE finds every entry contained in a string in one scan (the zero-width
+# lookahead also reports overlapping matches; alternatives stay in vocab order so
+# the lowest index wins at each position). The reverse test, string contained in
+# an entry, is a single find() over the newline-joined vocabulary.
+_VOCAB_LOWER = [v.lower() for v in SUBSTITUTION_VOCAB]
+_VOCAB_INDEX = {v: i for i, v in enumerate(_VOCAB_LOWER)}
+_VOCAB_RE = re.compile('(?=(' + '|'.join(map(re.escape, _VOCAB_LOWER)) + '))')
+_VOCAB_JOINED = '\n'.join(_VOCAB_LOWER)
+_VOCAB_STARTS = list(accumulate((len(v) + 1 for v in _VOCAB_LOWER[:-1]), initial=0))
+
+@lru_cache(maxsize=65536)
+def _match_substitution(s: str) -> Optional[str]:
+    """Map one raw substitution to its vocabulary entry, or None.
+    
+    Raw annotations repeat heavily, so results are cached per distinct string.
+    """
+    s_lower = s.lower().strip()
+    
+    # Match against vocabulary: first entry contained in s, or containing s
+    matches = [_VOCAB_INDEX[m] for m in _VOCAB_RE.findall(s_lower)]
+    if '\n' not in s_lower:
+        pos = _VOCAB_JOINED.find(s_lower)
+        if pos >= 0:
+            matches.append(bisect_right(_VOCAB_STARTS, pos) - 1)
+    
+    if matches:
+        return SUBSTITUTION_VOCAB[min(matches)]
+    
+    # Try to match key patterns
+    if 'x = 0' in s_lower or 'x=0' in s_lower:
+        return 'x = 0'
+    elif 'y = 0' in s_lower or 'y=0' in s_lower:
+        return 'y = 0'
+    elif 'am-gm' in s_lower or 'amgm' in s_lower:
+        return 'Apply AM-GM'
+    elif 'cauchy' in s_lower:
+        return 'Apply Cauchy-Schwarz'
+    elif 'linear' in s_lower:
+        return 'Assume f is linear'
+    return None
+
 class SubstitutionDataset(Dataset):
     """Dataset for substitution prediction."""
     
-    def __init__(self, problems: List[Dict], tokenizer, mlb, max_length: int = 256):
+    def __init__(self, problems: List[Dict], tokenizer, max_length: int = 256):
         self.tokenizer = tokenizer
-        self.mlb = mlb
+        self.label_to_idx = {label: i for i, label in enumerate(SUBSTITUTION_VOCAB)}
         self.max_length = max_length
         self.data = []
         
@@ -81,55 +130,40 @@ class SubstitutionDataset(Dataset):
                     'text': text,
                     'substitutions': normalized_subs,
                 })
+        
+        # Tokenize everything once up front instead of per __getitem__
+        # (the fast tokenizer rejects an empty batch, so skip it then)
+        if self.data:
+            self.encodings = tokenizer(
+                [item['text'] for item in self.data],
+                truncation=True,
+                max_length=max_length,
+                padding='max_length',
+                return_tensors='pt',
+            )
+        else:
+            empty = torch.zeros((0, max_length), dtype=torch.long)
+            self.encodings = {'input_ids': empty, 'attention_mask': empty}
+        
+        # Multi-hot targets, binarized once: (N, |vocab|)
+        labels = np.zeros((len(self.data), len(SUBSTITUTION_VOCAB)), dtype=np.float32)
+        for row, item in enumerate(self.data):
+            labels[row, [self.label_to_idx[s] for s in item['substitutions']]] = 1.0
+        self.labels = torch.from_numpy(labels)
     
     def _normalize_substitutions(self, subs: List[str]) -> List[str]:
         """Map substitutions to vocabulary."""
-        normalized = []
-        for s in subs:
-            s_lower = s.lower().strip()
-            
-            # Match against vocabulary
-            for vocab_sub in SUBSTITUTION_VOCAB:
-                if vocab_sub.lower() in s_lower or s_lower in vocab_sub.lower():
-                    normalized.append(vocab_sub)
-                    break
-            else:
-                # Try to match key patterns
-                if 'x = 0' in s_lower or 'x=0' in s_lower:
-                    normalized.append('x = 0')
-                elif 'y = 0' in s_lower or 'y=0' in s_lower:
-                    normalized.append('y = 0')
-                elif 'am-gm' in s_lower or 'amgm' in s_lower:
-                    normalized.append('Apply AM-GM')
-                elif 'cauchy' in s_lower:
-                    normalized.append('Apply Cauchy-Schwarz')
-                elif 'linear' in s_lower:
-                    normalized.append('Assume f is linear')
-                    
+        normalized = [m for m in map(_match_substitution, subs) if m is not None]
         return list(set(normalized))[:5]  # Dedupe and limit
     
     def __len__(self):
         return len(self.data)
     
     def __getitem__(self, idx):
-        item = self.data[idx]
-        
-        # Tokenize
-        encoding = self.tokenizer(
-            item['text'],
-            truncation=True,
-            max_length=self.max_length,
-            padding='max_length',
-            return_tensors='pt',
-        )
-        
-        # Multi-label target
-        labels = self.mlb.transform([item['substitutions']])
-        
         return {
-            'input_ids': encoding['input_ids'].squeeze(),
-            'attention_mask': encoding['attention_mask'].squeeze(),
-            'labels': torch.tensor(labels.squeeze(), dtype=torch.float),
+            'input_ids': self.encodings['input_ids'][idx],
+            'attention_mask': self.encodings['attention_mask'][idx],
+            'labels': self.labels[idx],
         }
 
 # ============================================================================
@@ -166,14 +200,15 @@ class DistilBertSubstitutionModel(torch.nn.Module):
 
 def compute_metrics(pred):
     """Compute accuracy metrics."""
-    labels = pred.label_ids
-    preds = (torch.sigmoid(torch.tensor(pred.predictions)) > 0.5).numpy()
+    labels = pred.label_ids.astype(bool)
+    preds = pred.predictions > 0  # sigmoid(x) > 0.5  <=>  x > 0
+    correct = preds == labels
     
     # Per-sample accuracy
-    exact_match = np.all(preds == labels, axis=1).mean()
+    exact_match = correct.all(axis=1).mean()
     
     # Per-label accuracy
-    label_accuracy = (preds == labels).mean()
+    label_accuracy = correct.mean()
     
     return {
         'exact_match': exact_match,
@@ -186,8 +221,13 @@ def train_model(
     epochs: int = 10,
     batch_size: int = 8,
     learning_rate: float = 2e-5,
+    target_batch_size: Optional[int] = None,
 ):
-    """Train the substitution prediction model."""
+    """Train the substitution prediction model.
+    
+    With target_batch_size, gradients are accumulated so the effective batch
+    stays at that size when batch_size has to be lowered to fit memory.
+    """
     
     # Load data
     print(f"Loading data from {data_path}...")
@@ -196,33 +236,46 @@ def train_model(
     
     print(f"Loaded {len(problems)} problems")
     
-    # Initialize tokenizer and label encoder
-    tokenizer = DistilBertTokenizer.from_pretrained('distilbert-base-uncased')
-    mlb = MultiLabelBinarizer(classes=SUBSTITUTION_VOCAB)
-    mlb.fit([SUBSTITUTION_VOCAB])  # Fit on full vocab
+    # Initialize tokenizer
+    tokenizer = DistilBertTokenizerFast.from_pretrained('distilbert-base-uncased')
     
     # Create dataset
-    dataset = SubstitutionDataset(problems, tokenizer, mlb)
+    dataset = SubstitutionDataset(problems, tokenizer)
     print(f"Created dataset with {len(dataset)} samples")
     
     if len(dataset) < 2:
         print("Not enough data for training. Add more annotated problems.")
         return
     
-    # Split
-    train_size = int(0.8 * len(dataset))
-    train_dataset = torch.utils.data.Subset(dataset, range(train_size))
-    eval_dataset = torch.utils.data.Subset(dataset, range(train_size, len(dataset)))
-    
     # Model
     model = DistilBertSubstitutionModel(num_labels=len(SUBSTITUTION_VOCAB))
     
+    # Mixed precision: BF16 on Ampere+, FP16 (loss-scaled) on older GPUs.
+    # TF32 Tensor Core matmuls for the remaining FP32 ops (Ampere+).
+    use_bf16 = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+    use_fp16 = torch.cuda.is_available() and not use_bf16
+    
+    accumulation_steps = max(1, (target_batch_size or batch_size) // batch_size)
+    
+    # Inputs are always padded to 256 tokens, so shapes are static and
+    # reduce-overhead (CUDA graphs) can replay the whole step
+    use_compile = hasattr(torch, 'compile') and torch.cuda.is_available()
+    
+    # Background loader workers keep batches ready while the GPU runs
+    num_workers = max(1, (os.cpu_count() or 2) // 2)
+    
     # Training args
     training_args = TrainingArguments(
         output_dir=str(output_dir / 'checkpoints'),
         num_train_epochs=epochs,
         per_device_train_batch_size=batch_size,
         per_device_eval_batch_size=batch_size,
+        gradient_accumulation_steps=accumulation_steps,
+        bf16=use_bf16,
+        fp16=use_fp16,
+        tf32=use_bf16,  # TF32 needs Ampere+, same as BF16
+        torch_compile=use_compile,
+        torch_compile_mode='reduce-overhead' if use_compile else None,
         warmup_steps=50,
         weight_decay=0.01,
         logging_dir=str(output_dir / 'logs'),
@@ -232,8 +285,23 @@ def train_model(
         load_best_model_at_end=True,
         metric_for_best_model='label_accuracy',
         greater_is_better=True,
+        save_safetensors=True,  # mmap-able weights for the inference loaders
+        # Under torchrun: every parameter gets a gradient, so skip the unused-param
+        # graph walk; smaller buckets start all-reduce earlier in backward
+        ddp_find_unused_parameters=False,
+        ddp_bucket_cap_mb=25,
+        dataloader_num_workers=num_workers,
+        dataloader_pin_memory=True,
+        dataloader_persistent_workers=True,
+        dataloader_prefetch_factor=2,
     )
     
+    # Split: shuffled, seeded with the Trainer seed so runs are reproducible
+    train_size = int(0.8 * len(dataset))
+    indices = np.random.default_rng(training_args.seed).permutation(len(dataset))
+    train_dataset = torch.utils.data.Subset(dataset, indices[:train_size].tolist())
+    eval_dataset = torch.utils.data.Subset(dataset, indices[train_size:].tolist())
+    
     # Trainer
     trainer = Trainer(
         model=model.bert,
@@ -248,58 +316,123 @@ def train_model(
     print("Starting training...")
     trainer.train()
     
-    # Save
+    # Save (save_model only writes on rank 0; the rest is guarded by hand)
     print(f"Saving model to {output_dir}...")
     trainer.save_model(str(output_dir / 'final'))
-    tokenizer.save_pretrained(str(output_dir / 'final'))
-    
-    # Save label encoder
-    with open(output_dir / 'label_vocab.json', 'w') as f:
-        json.dump(SUBSTITUTION_VOCAB, f)
+    if trainer.is_world_process_zero():
+        tokenizer.save_pretrained(str(output_dir / 'final'))
+        
+        # Save label encoder
+        with open(output_dir / 'label_vocab.json', 'w') as f:
+            json.dump(SUBSTITUTION_VOCAB, f)
     
     print("Training complete!")
-    return model, tokenizer, mlb
+    return model, tokenizer, SUBSTITUTION_VOCAB
 
 # ============================================================================
 # ONNX Export
 # ============================================================================
 
-def export_to_onnx(model_dir: Path, output_path: Path):
+class ExportWrapper(torch.nn.Module):
+    """Classifier followed by sigmoid + top-k for export.
+    
+    The ONNX graph then returns only the k best (probability, label index)
+    pairs instead of the full logits.
+    """
+    
+    def __init__(self, model, top_k: int):
+        super().__init__()
+        self.model = model
+        self.top_k = top_k
+    
+    def forward(self, input_ids, attention_mask):
+        logits = self.model(input_ids=input_ids, attention_mask=attention_mask).logits
+        probs = torch.sigmoid(logits)
+        values, indices = torch.topk(probs, k=self.top_k, dim=-1)
+        return values, indices
+
+def export_to_onnx(model_dir: Path, output_path: Path, top_k: int = 3):
     """Export trained model to ONNX format for Rust inference."""
-    from transformers import DistilBertForSequenceClassification, DistilBertTokenizer
+    from transformers import DistilBertForSequenceClassification, DistilBertTokenizerFast
     import torch.onnx
     
     print(f"Loading model from {model_dir}...")
-    model = DistilBertForSequenceClassification.from_pretrained(str(model_dir))
-    tokenizer = DistilBertTokenizer.from_pretrained(str(model_dir))
+    model = DistilBertForSequenceClassification.from_pretrained(
+        str(model_dir), use_safetensors=True, low_cpu_mem_usage=True,
+    )
+    tokenizer = DistilBertTokenizerFast.from_pretrained(str(model_dir))
     
     model.eval()
     
-    # Dummy input
+    # Dummy input (unpadded; sequence length is a dynamic axis)
     dummy_text = "Find all functions f: R → R such that f(x + y) = f(x) + f(y)."
-    inputs = tokenizer(dummy_text, return_tensors='pt', max_length=256, truncation=True, padding='max_length')
+    inputs = tokenizer(dummy_text, return_tensors='pt', max_length=256, truncation=True)
     
     # Export
     print(f"Exporting to {output_path}...")
+    top_k = min(top_k, model.config.num_labels)
     torch.onnx.export(
-        model,
+        ExportWrapper(model, top_k),
         (inputs['input_ids'], inputs['attention_mask']),
         str(output_path),
         input_names=['input_ids', 'attention_mask'],
-        output_names=['logits'],
+        output_names=['topk_values', 'topk_indices'],
         dynamic_axes={
-            'input_ids': {0: 'batch'},
-            'attention_mask': {0: 'batch'},
-            'logits': {0: 'batch'},
+            'input_ids': {0: 'batch', 1: 'seq'},
+            'attention_mask': {0: 'batch', 1: 'seq'},
+            'topk_values': {0: 'batch'},
+            'topk_indices': {0: 'batch'},
         },
         opset_version=14,
     )
     
     print(f"ONNX model saved to {output_path}")
     
+    from onnxruntime.transformers.optimizer import optimize_model
+    
+    # FP16 variant for CUDAExecutionProvider: half the bandwidth, Tensor Core GEMMs.
+    # Fused from the unfused export with the GPU patterns, then converted by ORT's
+    # own converter, which knows the fused com.microsoft ops. keep_io_types leaves
+    # inputs/outputs FP32 so callers need no casts.
+    fp16_path = output_path.with_suffix('.fp16.onnx')
+    try:
+        optimized_gpu = optimize_model(
+            str(output_path),
+            model_type='bert',
+            num_heads=model.config.n_heads,
+            hidden_size=model.config.dim,
+            opt_level=0,  # Python fusions only, so no CUDA build of ORT is needed here
+            use_gpu=True,
+        )
+        optimized_gpu.convert_float_to_float16(keep_io_types=True)
+        optimized_gpu.save_model_to_file(str(fp16_path))
+        size_mb = fp16_path.stat().st_size / (1024 * 1024)
+        print(f"FP16 model saved to {fp16_path} ({size_mb:.1f} MB)")
+    except Exception as e:
+        print(f"FP16 conversion failed, keeping the FP32 model only: {e}")
+    
+    # Fuse Attention / SkipLayerNorm / EmbedLayerNorm / Gelu subgraphs for CPU.
+    # The fused graph uses com.microsoft ops, so it goes to its own file and the
+    # portable export stays untouched; verify and quantize the fused graph.
+    opt_path = output_path.with_suffix('.opt.onnx')
+    cpu_path = output_path
+    try:
+        optimized = optimize_model(
+            str(output_path),
+            model_type='bert',  # DistilBERT uses the BERT fusion patterns
+            num_heads=model.config.n_heads,
+            hidden_size=model.config.dim,
+            opt_level=99,
+            use_gpu=False,
+        )
+        optimized.save_model_to_file(str(opt_path))
+        cpu_path = opt_path
+        print(f"Fused transformer graph saved to {opt_path}")
+    except Exception as e:
+        print(f"Graph fusion failed, using the unfused model: {e}")
+    
     # Verify
-    import onnxruntime as ort
-    session = ort.InferenceSession(str(output_path))
+    session = _ort_session(str(cpu_path))
     result = session.run(
         None,
         {
@@ -308,42 +441,183 @@ def export_to_onnx(model_dir: Path, output_path: Path):
         }
     )
     print(f"Verification passed! Output shape: {result[0].shape}")
+    
+    # INT8 dynamic quantization: ~4x smaller weights, VNNI int8 GEMMs on CPU.
+    # Dynamic (not static QDQ) keeps accuracy for transformer classifiers.
+    try:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+    except ImportError:
+        print("onnxruntime.quantization unavailable, skipping the INT8 model")
+        return
+    
+    int8_path = output_path.with_suffix('.int8.onnx')
+    try:
+        quantize_dynamic(
+            str(cpu_path),
+            str(int8_path),
+            weight_type=QuantType.QInt8,
+            op_types_to_quantize=['MatMul', 'Gemm'],
+        )
+        size_mb = int8_path.stat().st_size / (1024 * 1024)
+        print(f"INT8 model saved to {int8_path} ({size_mb:.1f} MB)")
+    except Exception as e:
+        print(f"INT8 quantization failed, keeping the FP32 model only: {e}")
 
 # ============================================================================
 # Inference
 # ============================================================================
 
+def _ort_session(onnx_path: str):
+    """Create an InferenceSession with full graph optimization on all cores."""
+    import onnxruntime as ort
+    
+    so = ort.SessionOptions()
+    so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    so.intra_op_num_threads = os.cpu_count() or 1
+    # The encoder is one sequential chain, so parallelism comes from intra-op threads
+    so.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    
+    available = ort.get_available_providers()
+    providers = [p for p in ('CUDAExecutionProvider', 'CPUExecutionProvider') if p in available]
+    return ort.InferenceSession(onnx_path, sess_options=so, providers=providers)
+
+@lru_cache(maxsize=4)
+def _load_onnx(onnx_path: str, model_dir: str):
+    """Load (session, tokenizer, labels) once per exported model."""
+    from transformers import DistilBertTokenizerFast
+    
+    tokenizer = DistilBertTokenizerFast.from_pretrained(model_dir)
+    
+    with open(Path(model_dir) / 'label_vocab.json', 'r') as f:
+        labels = json.load(f)
+    
+    return _ort_session(onnx_path), tokenizer, labels
+
+# Input shape the TorchScript model is traced (and frozen) with. The trace is
+# only valid for exactly this shape, so it serves single texts padded to 256.
+_JIT_SHAPE = (1, 256)
+
+@lru_cache(maxsize=4)
+def _load(model_dir: str, jit: bool = False):
+    """Load (model, tokenizer, labels) once per model directory.
+    
+    With jit=True the model is traced with torch.jit.trace on a _JIT_SHAPE
+    input and frozen with optimize_for_inference; only predict_substitutions
+    uses it, and it checks its inputs match that shape.
+    """
+    from transformers import DistilBertForSequenceClassification, DistilBertTokenizerFast
+    
+    # safetensors + low_cpu_mem_usage: weights are mmapped, no staging copy.
+    # torchscript=True makes the model return tuples, which tracing requires.
+    model = DistilBertForSequenceClassification.from_pretrained(
+        model_dir, use_safetensors=True, low_cpu_mem_usage=True, torchscript=jit,
+    )
+    tokenizer = DistilBertTokenizerFast.from_pretrained(model_dir)
+    
+    with open(Path(model_dir) / 'label_vocab.json', 'r') as f:
+        labels = json.load(f)
+    
+    model.eval()
+    
+    if jit:
+        dummy = tokenizer("x", return_tensors='pt', max_length=_JIT_SHAPE[1], truncation=True, padding='max_length')
+        example = (dummy['input_ids'], dummy['attention_mask'])
+        with torch.no_grad():
+            model = torch.jit.trace(model, example, strict=False)
+            model = torch.jit.optimize_for_inference(model)
+            # The profiling executor fuses on later runs, so warm up before use
+            for _ in range(3):
+                model(*example)
+    
+    return model, tokenizer, labels
+
 def predict_substitutions(
     text: str,
     model_dir: Path,
     top_k: int = 3,
+    jit: bool = False,
 ) -> List[Tuple[str, float]]:
     """Predict top-k substitutions for a problem."""
-    from transformers import DistilBertForSequenceClassification, DistilBertTokenizer
+    # Load (cached after the first call for this model_dir)
+    model, tokenizer, labels = _load(str(model_dir), jit)
     
-    # Load
-    model = DistilBertForSequenceClassification.from_pretrained(str(model_dir))
-    tokenizer = DistilBertTokenizer.from_pretrained(str(model_dir))
+    # Tokenize (no padding: attention cost scales with the real length;
+    # the traced model needs the fixed shape it was traced with)
+    padding = 'max_length' if jit else False
+    inputs = tokenizer(text, return_tensors='pt', max_length=256, truncation=True, padding=padding)
+    if jit and tuple(inputs['input_ids'].shape) != _JIT_SHAPE:
+        raise ValueError(f"traced model expects input shape {_JIT_SHAPE}, got {tuple(inputs['input_ids'].shape)}")
     
-    with open(model_dir / 'label_vocab.json', 'r') as f:
-        labels = json.load(f)
+    # Predict; [0] is the logits for both the eager and the traced model
+    with torch.no_grad():
+        logits = model(inputs['input_ids'], inputs['attention_mask'])[0]
     
-    model.eval()
+    probs = torch.sigmoid(logits).squeeze().numpy()
     
-    # Tokenize
-    inputs = tokenizer(text, return_tensors='pt', max_length=256, truncation=True, padding='max_length')
+    # Get top-k: O(L) partition, then sort only the k survivors
+    top_k = min(top_k, probs.shape[0])
+    idx = np.argpartition(probs, -top_k)[-top_k:]
+    top_indices = idx[np.argsort(-probs[idx])]
+    results = [(labels[i], float(probs[i])) for i in top_indices]
+    
+    return results
+
+def predict_substitutions_batch(
+    texts: List[str],
+    model_dir: Path,
+    top_k: int = 3,
+) -> List[List[Tuple[str, float]]]:
+    """Predict top-k substitutions for many problems in one forward pass.
+    
+    Always eager: the traced model is tied to the single-text shape it was
+    traced with, so it cannot serve variable batches.
+    """
+    model, tokenizer, labels = _load(str(model_dir))
+    
+    # Pad to the longest text in the batch, not to max_length
+    inputs = tokenizer(texts, return_tensors='pt', max_length=256, truncation=True, padding=True)
     
-    # Predict
     with torch.no_grad():
         outputs = model(**inputs)
     
-    probs = torch.sigmoid(outputs.logits).squeeze().numpy()
+    probs = torch.sigmoid(outputs.logits).numpy()  # (B, L)
     
-    # Get top-k
-    top_indices = probs.argsort()[-top_k:][::-1]
-    results = [(labels[i], float(probs[i])) for i in top_indices]
+    # Top-k per row: O(L) partition, then order only the k survivors
+    top_k = min(top_k, probs.shape[1])
+    idx = np.argpartition(probs, -top_k, axis=1)[:, -top_k:]
+    top = np.take_along_axis(probs, idx, axis=1)
+    order = np.argsort(-top, axis=1)
+    idx = np.take_along_axis(idx, order, axis=1)
     
-    return results
+    return [
+        [(labels[i], float(row[i])) for i in row_idx]
+        for row, row_idx in zip(probs, idx)
+    ]
+
+def predict_substitutions_onnx(
+    text: str,
+    model_dir: Path,
+    onnx_path: Path,
+    top_k: int = 3,
+) -> List[Tuple[str, float]]:
+    """Predict top-k substitutions with the exported ONNX model.
+    
+    The graph already ends in sigmoid + TopK, so top_k is capped at the k it
+    was exported with.
+    """
+    # The session (and its graph optimization) is built once per onnx_path
+    session, tokenizer, labels = _load_onnx(str(onnx_path), str(model_dir))
+    
+    inputs = tokenizer(text, return_tensors='np', max_length=256, truncation=True)
+    values, indices = session.run(
+        ['topk_values', 'topk_indices'],
+        {
+            'input_ids': inputs['input_ids'],
+            'attention_mask': inputs['attention_mask'],
+        }
+    )
+    
+    return [(labels[i], float(v)) for v, i in zip(values[0][:top_k], indices[0][:top_k])]
 
 # ============================================================================
 # Main
@@ -355,6 +629,8 @@ def main():
     parser.add_argument("--output", type=Path, default=Path("model"), help="Output directory")
     parser.add_argument("--epochs", type=int, default=10, help="Training epochs")
     parser.add_argument("--batch-size", type=int, default=8, help="Batch size")
+    parser.add_argument("--target-batch-size", type=int, default=None,
+                        help="Effective batch size; accumulates gradients over --batch-size steps")
     parser.add_argument("--export-onnx", action="store_true", help="Export to ONNX after training")
     
     args = parser.parse_args()
@@ -367,10 +643,11 @@ def main():
         output_dir=args.output,
         epochs=args.epochs,
         batch_size=args.batch_size,
+        target_batch_size=args.target_batch_size,
     )
     
-    # Export to ONNX
-    if args.export_onnx:
+    # Export to ONNX (rank 0 only under torchrun: every rank would write the same files)
+    if args.export_onnx and int(os.environ.get("RANK", 0)) == 0:
         export_to_onnx(
             model_dir=args.output / 'final',
             output_path=args.output / 'substitution_model.onnx',